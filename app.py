@@ -1,19 +1,19 @@
 import os, pickle
 from src.converters.image_mask import image_mask_write
-from PyQt5.QtCore import QModelIndex, Qt
+from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QKeySequence
-from PyQt5.QtWidgets import (QApplication, QFileDialog, QMainWindow, QMessageBox, QShortcut, QTreeView, QUndoStack, QUndoView, QVBoxLayout, QWidget)
+from PyQt5.QtWidgets import (QApplication, QFileDialog, QMainWindow, QMessageBox, QShortcut, QTreeView, QVBoxLayout, QWidget)
 
 from src.bar import PangoMenuBarWidget, PangoToolBarWidget
+from src.cache import PangoPyramidCache
 from src.converters.pascal_voc import pascal_voc_read, pascal_voc_write
 from src.converters.yolo import yolo_read, yolo_write
-from src.dock import PangoFileWidget, PangoLabelWidget, PangoUndoWidget
+from src.dock import PangoFileWidget, PangoLabelWidget, PangoUndoView, PangoUndoWidget
 from src.dialog import ExportSettingsDialog, ImportSettingsDialog
 from src.graphics import PangoGraphicsView
+from src.history import pango_history_records, pango_pack_history, pango_record_shapes, pango_restore_history, pango_unpack_history
 from src.interface import PangoModelSceneInterface
-
-app = QApplication([])
-QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps)
+from src.utils import pango_is_image
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -27,13 +27,13 @@ class MainWindow(QMainWindow):
 
         self.tree_view = QTreeView()
         self.tree_view.setUniformRowHeights(True)
-        self.tree_view.setModel(self.interface.model)
+        self.tree_view.setModel(self.interface.tree_model)
         self.interface.set_tree(self.tree_view)
 
         self.graphics_view = PangoGraphicsView()
         self.graphics_view.setScene(self.interface.scene)
 
-        self.undo_view = QUndoView()
+        self.undo_view = PangoUndoView()
 
         # Dock widgets
         self.label_widget = PangoLabelWidget("Labels", self.tree_view)
@@ -46,6 +46,13 @@ class MainWindow(QMainWindow):
         self.tool_bar.set_scene(self.interface.scene)
         self.tool_bar.label_select.setModel(self.interface.model)
 
+        # Background image caching
+        self.pyramid_cache = PangoPyramidCache()
+        self.prefetch_count = 2
+
+        # Saved undo histories, restored when their image is opened
+        self.pending_history = {}
+
         # Signals and Slots
         self.menu_bar.open_images_action.triggered.connect(self.load_images)
         self.menu_bar.export_action.triggered.connect(self.export_project)
@@ -56,6 +63,8 @@ class MainWindow(QMainWindow):
         self.file_widget.file_model.directoryLoaded.connect(self.after_loaded_images)
         self.tool_bar.label_select.currentIndexChanged.connect(self.interface.switch_label)
         self.tool_bar.del_labels_signal.connect(self.interface.del_labels)
+        self.pyramid_cache.progress.connect(self.show_cache_progress)
+        self.interface.scene.stack_compacted.connect(self.stack_compacted)
 
         # Layouts
         self.bg = QWidget()
@@ -111,15 +120,16 @@ class MainWindow(QMainWindow):
         p_fpath = self.file_widget.file_model.filePath(p_idx)
 
         self.interface.scene.set_fpath(c_fpath)
+        self.interface.scene.image_cache.prefetch(
+                self.file_widget.neighbour_fpaths(self.prefetch_count))
         self.interface.scene.reset_com()
         self.graphics_view.fitInView(self.interface.scene.sceneRect(), Qt.KeepAspectRatio)
 
         # Handling unsaved changes
-        if c_fpath not in self.interface.scene.change_stacks.keys():
-            self.interface.scene.change_stacks[c_fpath] = QUndoStack()
-        self.undo_view.setStack(self.interface.scene.change_stacks[c_fpath])
-        self.interface.scene.stack = self.interface.scene.change_stacks[c_fpath]
+        self.interface.scene.stack = self.interface.scene.stack_for(c_fpath)
+        self.undo_view.setStack(self.interface.scene.stack)
         self.interface.filter_tree(c_fpath, p_fpath)
+        self.restore_history(c_fpath)
 
     def load_images(self, action=None, fpath=None):
         if fpath is None:
@@ -133,11 +143,20 @@ class MainWindow(QMainWindow):
             self.file_widget.file_view.setRootIndex(root_idx)
             self.images_are_new = True
 
+            self.pyramid_cache.start([os.path.join(fpath, f)
+                for f in sorted(os.listdir(fpath)) if pango_is_image(f)])
+
+    def show_cache_progress(self, done, total):
+        if done < total:
+            self.tool_bar.info_display.setText("Caching "+str(done)+"/"+str(total))
+        else:
+            self.tool_bar.info_display.setText("")
+
     def after_loaded_images(self):
         if self.images_are_new is True:
             folder_path = self.file_widget.file_model.rootPath()
             for f in sorted(os.listdir(folder_path)):
-                if f.endswith(".jpg") or f.endswith(".png"):
+                if pango_is_image(f):
                     idx = self.file_widget.file_model.index(os.path.join(folder_path, f))
                     self.file_widget.file_view.setCurrentIndex(idx)
                     break
@@ -151,10 +170,27 @@ class MainWindow(QMainWindow):
             project_path = os.path.join(
                     self.file_widget.file_model.rootPath(), "pangolin_project.p")
 
+        # Shapes are looked up by graphic in live stacks, by key in pending ones
         pickle_items = []
-        for k in self.interface.map.keys():
-            pickle_items.append(self.interface.model.itemFromIndex(QModelIndex(k)))
-        pickle.dump(pickle_items, open(project_path, "wb"))
+        ids = {}
+        for row in range(0, self.interface.model.rowCount()):
+            label = self.interface.model.item(row)
+            for item in [label]+label.children():
+                ids[item.key()] = len(pickle_items)
+                if item.key() in self.interface.map:
+                    ids[self.interface.map[item.key()]] = len(pickle_items)
+                pickle_items.append(item)
+
+        history = {}
+        for fpath, (data, keys) in self.pending_history.items():
+            history[fpath] = pango_pack_history(pango_unpack_history(data, keys), ids)
+        for fpath, stack in self.interface.scene.change_stacks.items():
+            if fpath != "" and stack.count() > 0:
+                history[fpath] = pango_pack_history(pango_history_records(stack), ids)
+
+        pickle.dump({"items": pickle_items, "history": history}, open(project_path, "wb"))
+        for stack in self.interface.scene.change_stacks.values():
+            stack.setClean()
 
     def load_project(self, action=None, project_path=None):
         if project_path is None:
@@ -164,18 +200,47 @@ class MainWindow(QMainWindow):
         if os.path.exists(project_path):
             self.clear_project()
 
-            unpickled_items = pickle.load(open(project_path, "rb"))
-            for item in unpickled_items:
+            project = pickle.load(open(project_path, "rb"))
+            if type(project) is list: # Saved without history
+                project = {"items": project, "history": {}}
+
+            for item in project["items"]:
                 if item.parent() is None:
                     self.interface.model.appendRow(item)
                 item.force_update()
 
+            keys = [item.key() for item in project["items"]]
+            for fpath, data in project["history"].items():
+                self.pending_history[fpath] = (data, keys)
+
             self.interface.filter_tree(self.interface.scene.fpath, None)
+            self.restore_history(self.interface.scene.fpath)
+
+    def restore_history(self, fpath):
+        pending = self.pending_history.pop(fpath, None)
+        if pending is not None:
+            scene = self.interface.scene
+            data, keys = pending
+            gfxs = [self.interface.map.get(key) for key in keys]
+            pango_restore_history(scene, pango_unpack_history(data, gfxs), fpath)
+            scene.stack.setClean()
+
+    # Compacted histories are packed as if saved, and restored on the next visit
+    def stack_compacted(self, fpath, stack):
+        records = pango_history_records(stack)
+        keys = [self.interface.map.inverse[gfx] for gfx in set(pango_record_shapes(records))
+                if gfx in self.interface.map.inverse]
+        ids = {self.interface.map[key]: i for i, key in enumerate(keys)}
+        self.pending_history[fpath] = (pango_pack_history(records, ids), keys)
 
     def clear_project(self, action=None, show_dialog=True):
         self.interface.map.clear()
+        self.interface.clear_index()
         self.interface.model.clear()
         self.interface.scene.full_clear()
+        for stack in self.interface.scene.change_stacks.values():
+            stack.clear()
+        self.pending_history.clear()
 
     def export_project(self, action=None):
         folder_path = self.file_widget.file_model.rootPath()
@@ -209,6 +274,8 @@ class MainWindow(QMainWindow):
                     self.file_widget.file_view.setCurrentIndex(idx)
                     image_mask_write(self.interface, fpath, mask_folder)
 
+            self.interface.scene.metadata.save()
+
         self.interface.filter_tree(self.interface.scene.fpath, None)
 
     def import_project(self, action=None, folder=None):
@@ -261,8 +328,17 @@ class MainWindow(QMainWindow):
     def export_warning_dialog(self):
         pass
 
-window = MainWindow()
-window.show()
+    def closeEvent(self, event):
+        self.pyramid_cache.shutdown()
+        self.interface.scene.image_cache.shutdown()
+        self.interface.scene.metadata.save()
+        super().closeEvent(event)
 
+# Guarded, as cache worker processes re-import this module
 if __name__ == '__main__':
+    app = QApplication([])
+    QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps)
+
+    window = MainWindow()
+    window.show()
     app.exec_()
@@ -0,0 +1,78 @@
+""" Paint time of a dense scene, with shared render context metrics against
+   the per call dw() they replaced. Most of a frame goes to rasterizing the
+   shapes, the metrics are a few percent of it, see --profile. Run from the
+   repository root with python -m benchmarks.paint_scene [n_shapes] [--profile] """
+import cProfile, pstats, random, sys, time
+
+from PyQt5.QtCore import QPointF, QRectF, QSize
+from PyQt5.QtGui import QColor, QImage, QPainter
+from PyQt5.QtWidgets import QApplication
+
+from src.graphics import PangoGraphicsScene
+from src.item import PangoBboxGraphic, PangoGraphic, PangoLabelGraphic, PangoPolyGraphic, PolygonF
+
+def build_scene(n_shapes=2000, size=QSize(4000, 3000)):
+    scene = PangoGraphicsScene()
+    scene.image.set_preview(QImage(), size)
+    scene.context.set_size(size)
+    scene.setSceneRect(scene.image.rect())
+
+    label = PangoLabelGraphic()
+    scene.addItem(label)
+    label.name = "label"
+    label.color = QColor("red")
+
+    rng = random.Random(0)
+    for n in range(0, n_shapes):
+        x, y = rng.uniform(0, size.width()-100), rng.uniform(0, size.height()-100)
+        if n % 2:
+            gfx = PangoBboxGraphic()
+            gfx.rect = QRectF(x, y, rng.uniform(20, 100), rng.uniform(20, 100))
+        else:
+            gfx = PangoPolyGraphic()
+            gfx.poly = PolygonF()
+            for _ in range(0, 8):
+                gfx.poly.append(QPointF(x+rng.uniform(0, 100), y+rng.uniform(0, 100)))
+            gfx.poly.append(gfx.poly.first())
+        gfx.setParentItem(label)
+    return scene, label
+
+def paint_time(scene, label, frames=20):
+    img = QImage(QSize(1600, 1200), QImage.Format_ARGB32_Premultiplied)
+    start = time.perf_counter()
+    for _ in range(0, frames):
+        label.invalidate_layer() # Every shape is painted again
+        painter = QPainter(img)
+        scene.render(painter)
+        painter.end()
+    return (time.perf_counter()-start)/frames*1000
+
+# Functions taking most of the paint time, with the render context
+def paint_profile(scene, label, frames=10, limit=10):
+    profile = cProfile.Profile()
+    profile.runcall(paint_time, scene, label, frames)
+    pstats.Stats(profile).sort_stats("tottime").print_stats(limit)
+
+def legacy_dw(self):
+    rect = self.scene().image.rect()
+    if rect != QRectF():
+        return (rect.size().height()+rect.size().width())/400
+    else:
+        return 10
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    n_shapes = int(args[0]) if args else 2000
+    scene, label = build_scene(n_shapes)
+    paint_time(scene, label, 2) # Warm up
+
+    dw = PangoGraphic.dw
+    PangoGraphic.dw = legacy_dw
+    before = paint_time(scene, label)
+    PangoGraphic.dw = dw
+    after = paint_time(scene, label)
+
+    print("%d shapes, ms per frame: per call dw() %.1f, render context %.1f" % (n_shapes, before, after))
+    if "--profile" in sys.argv:
+        paint_profile(scene, label)
@@ -0,0 +1,45 @@
+""" Time per point while drawing one long path stroke, early and late in the
+   stroke, with the view repainting after every point. Run from the
+   repository root with python -m benchmarks.stroke_points """
+import sys, time
+
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtWidgets import QApplication
+
+from src.graphics import CreateShape, ExtendShape, PangoGraphicsScene, PangoGraphicsView
+from src.item import PangoLabelGraphic, PangoPathGraphic
+
+def stroke_times(n_points, window=500):
+    scene = PangoGraphicsScene()
+    scene.fpath = ""
+    scene.setSceneRect(QRectF(0, 0, 4000, 4000))
+    view = PangoGraphicsView()
+    view.setScene(scene)
+    view.resize(800, 800)
+    view.show()
+
+    label = PangoLabelGraphic()
+    scene.addItem(label)
+    com = CreateShape(PangoPathGraphic, QPointF(10, 10), label)
+    scene.push(com)
+    scene.push(ExtendShape(QPointF(10, 10), com.gfx, "moveTo"))
+
+    times = []
+    for n in range(0, n_points):
+        x, y = 10+(n*7)%3900, 10+(n//557)*7
+        start = time.perf_counter()
+        scene.push(ExtendShape(QPointF(x, y), com.gfx, "lineTo"))
+        QApplication.processEvents()
+        times.append(time.perf_counter()-start)
+    com.gfx.settle_geometry()
+
+    first = sum(times[:window])/window*1000
+    last = sum(times[-window:])/window*1000
+    return first, last
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    first, last = stroke_times(n_points)
+    print("%d points, ms per point: first 500 %.3f, last 500 %.3f" % (n_points, first, last))
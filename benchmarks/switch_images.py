@@ -0,0 +1,53 @@
+""" Time per image switch between a few annotated images, with shapes of
+   recent images removed from the scene (park_limit 0) or parked in it.
+   Run from the repository root with python -m benchmarks.switch_images """
+import sys, time
+
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtWidgets import QApplication, QTreeView
+
+from src.graphics import CreateShape, ExtendShape, PangoGraphicsView
+from src.interface import PangoModelSceneInterface
+from src.item import PangoLabelItem, PangoPolyGraphic
+
+def switch_times(park_limit, n_images=3, n_shapes=50, n_points=200, n_switches=60):
+    itf = PangoModelSceneInterface()
+    itf.set_tree(QTreeView())
+    itf.tree.setModel(itf.tree_model)
+    scene = itf.scene
+    scene.park_limit = park_limit
+    scene.setSceneRect(QRectF(0, 0, 4000, 4000))
+    view = PangoGraphicsView()
+    view.setScene(scene)
+    view.resize(800, 800)
+    view.show()
+
+    item = PangoLabelItem()
+    itf.model.invisibleRootItem().appendRow(item)
+    item.name = "Label"
+    item.visible = True
+    itf.switch_label(0)
+
+    fpaths = ["%d.jpg" % n for n in range(0, n_images)]
+    for fpath in fpaths:
+        scene.fpath = fpath
+        for s in range(0, n_shapes):
+            x, y = (s%10)*400, (s//10)*400
+            com = CreateShape(PangoPolyGraphic, QPointF(x, y), scene.active_label)
+            scene.push(com)
+            for n in range(1, n_points):
+                scene.push(ExtendShape(QPointF(x+n%20*15, y+n//20*30), com.gfx, "moveTo"))
+    itf.filter_tree(fpaths[0], None)
+    QApplication.processEvents()
+
+    start = time.perf_counter()
+    for n in range(1, n_switches+1):
+        scene.fpath = fpaths[n%n_images]
+        itf.filter_tree(fpaths[n%n_images], fpaths[(n-1)%n_images])
+        QApplication.processEvents()
+    return (time.perf_counter()-start)/n_switches*1000
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    for park_limit in (0, 2):
+        print("park_limit %d, ms per switch: %.2f" % (park_limit, switch_times(park_limit)))
@@ -0,0 +1,57 @@
+""" Time to unravel one shape with many images holding long histories, through
+   the command index against replaying every stack. Run from the repository
+   root with python -m benchmarks.unravel_shapes """
+import sys, time
+
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtWidgets import QApplication, QUndoCommand, QUndoStack
+
+from src.graphics import CreateShape, MoveShape, PangoGraphicsScene
+from src.item import PangoBboxGraphic, PangoGraphic
+
+def build_scene(n_images=700, n_shapes=20, n_moves=10):
+    scene = PangoGraphicsScene()
+    for i in range(0, n_images):
+        scene.stack = scene.change_stacks["image_%d.jpg" % i] = QUndoStack()
+        for j in range(0, n_shapes):
+            gfx = PangoBboxGraphic()
+            gfx.rect = QRectF(j, j, 10, 10)
+            for k in range(0, n_moves):
+                scene.push(MoveShape(QPointF(j+k+20, j+k+20), gfx, corner="bottomRight"))
+    return scene
+
+# The previous implementation, replaying every stack
+def legacy_unravel(scene, *gfxs):
+    for stack in scene.change_stacks.values():
+        for i in range(stack.count()-1, -1, -1):
+            com = stack.command(i)
+            if type(com) is QUndoCommand:
+                for j in range(0, com.childCount()):
+                    sub_com = com.child(j)
+                    if sub_com.gfx in gfxs:
+                        com.setObsolete(True)
+            else:
+                if com.gfx in gfxs:
+                    com.setObsolete(True)
+
+                if type(com) == CreateShape:
+                    break # Reached shape creation
+
+        stack.setIndex(0)
+        stack.setIndex(stack.count())
+    scene.active_com = CreateShape(PangoGraphic, QPointF(), PangoGraphic())
+
+def unravel_time(scene, unravel):
+    stack = scene.change_stacks["image_0.jpg"]
+    gfx = stack.command(0).gfx
+    start = time.perf_counter()
+    unravel(scene, gfx)
+    return (time.perf_counter()-start)*1000
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+
+    before = unravel_time(build_scene(n_images), legacy_unravel)
+    after = unravel_time(build_scene(n_images), PangoGraphicsScene.unravel_shapes)
+    print("%d images, 200 commands each, ms per unravel: replay %.1f, index %.2f" % (n_images, before, after))
@@ -0,0 +1,284 @@
+import json, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from PyQt5.QtCore import QObject, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+from .image import PangoLRUCache, PangoPyramidSource, pango_pyramid_dir, pango_read_image, pango_read_preview, pango_source_preview
+from .raster import pango_image_source, pango_raster_source, pango_tiled_source
+from .utils import pango_cache_dir, pango_file_key
+
+pango_gray_formats = (QImage.Format_Mono, QImage.Format_MonoLSB,
+                      QImage.Format_Grayscale8, QImage.Format_Grayscale16)
+
+# Reads only the file header, never the pixels
+def pango_read_info(fpath):
+    reader = QImageReader(fpath)
+    size = reader.size()
+    fmt = bytes(reader.format()).decode()
+    gray = reader.imageFormat() in pango_gray_formats
+
+    if not size.isValid():
+        src = pango_raster_source(fpath)
+        if src is None:
+            return None
+        size = src.size()
+        fmt = os.path.splitext(fpath)[1][1:].lower()
+        gray = src.spp == 1
+
+    return {"width": size.width(), "height": size.height(),
+            "depth": 1 if gray else 3, "grayscale": gray, "format": fmt}
+
+# Runs in a worker process, images fitting in min_size are fast enough to decode
+def pango_write_pyramid(fpath, min_size=2048):
+    folder = pango_pyramid_dir(fpath)
+    manifest = os.path.join(folder, "manifest.json")
+    if os.path.exists(manifest):
+        return fpath
+
+    if pango_raster_source(fpath) is not None:
+        return fpath # Read in place, losslessly
+    reader = QImageReader(fpath)
+    size = reader.size()
+    if max(size.width(), size.height()) <= min_size:
+        return fpath
+    src = pango_image_source(fpath)
+    if src is None:
+        return fpath
+
+    # Full resolution tiles are annotated on, so they are only lossy when
+    # the original is. Each level is composed from the tiles just written
+    # for the level below
+    ext = ".png" if bytes(reader.format()) == b"png" else ".jpg"
+    base_ext = ".jpg" if bytes(reader.format()) == b"jpeg" else ".png"
+    written = PangoPyramidSource(folder, size, src.tile_size, ext, base_ext)
+    os.makedirs(folder, exist_ok=True)
+    for level in range(0, src.level_count()):
+        cols, rows = src.tile_count(level)
+        for row in range(0, rows):
+            for col in range(0, cols):
+                if level == 0:
+                    tile = src.tile(level, col, row)
+                else:
+                    tile = written.compose_tile(level, col, row)
+                tile.save(written.tile_path(level, col, row), None, 95)
+
+    # Written last, so partial pyramids are never read
+    with open(manifest+".tmp", "w") as f:
+        json.dump({"width": size.width(), "height": size.height(),
+            "tile_size": src.tile_size, "ext": ext, "base_ext": base_ext}, f)
+    os.replace(manifest+".tmp", manifest)
+    return fpath
+
+
+""" PangoMetadataCache memoizes header information in one file per folder,
+   entries are invalidated when the image's size or mtime changes """
+class PangoMetadataCache(object):
+    def __init__(self):
+        self.folders = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def path(self, folder):
+        return os.path.join(folder, ".pangolin", "metadata.json")
+
+    def folder(self, fpath):
+        folder = os.path.dirname(os.path.abspath(fpath))
+        if folder not in self.folders:
+            try:
+                with open(self.path(folder)) as f:
+                    self.folders[folder] = json.load(f)
+            except (OSError, ValueError):
+                self.folders[folder] = {}
+        return folder, self.folders[folder]
+
+    def info(self, fpath):
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        stamp = [st.st_size, st.st_mtime_ns]
+
+        with self.lock:
+            folder, entries = self.folder(fpath)
+            entry = entries.get(os.path.basename(fpath))
+        if entry is not None and entry["stamp"] == stamp:
+            return entry
+
+        entry = pango_read_info(fpath)
+        if entry is not None:
+            entry["stamp"] = stamp
+            with self.lock:
+                entries[os.path.basename(fpath)] = entry
+                self.dirty.add(folder)
+        return entry
+
+    def size(self, fpath):
+        entry = self.info(fpath)
+        return QSize(entry["width"], entry["height"]) if entry is not None else QSize()
+
+    def save(self):
+        with self.lock:
+            for folder in self.dirty:
+                fpath = self.path(folder)
+                try:
+                    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                    with open(fpath+".tmp", "w") as f:
+                        json.dump(self.folders[folder], f)
+                    os.replace(fpath+".tmp", fpath)
+                except OSError:
+                    pass
+            self.dirty.clear()
+
+""" PangoPyramidCache pre-generates on-disk tile pyramids for a folder of
+   images in worker processes, so the viewer never has to decode them whole """
+class PangoPyramidCache(QObject):
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, workers=None, parent=None):
+        super().__init__(parent)
+        self.workers = workers or max(1, (os.cpu_count() or 2)-1)
+        self.executor = None
+        self.futures = []
+        self.batch = 0
+        self.done = 0
+
+    def start(self, fpaths):
+        self.cancel()
+        if self.executor is None:
+            # Spawned, so workers never inherit the GUI process's threads
+            self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+        self.done = 0
+        self.futures = [self.executor.submit(pango_write_pyramid, fpath) for fpath in fpaths]
+        for future in self.futures:
+            future.add_done_callback(partial(self.future_done, self.batch))
+        self.progress.emit(0, len(self.futures))
+
+    def future_done(self, batch, future):
+        if batch != self.batch or future.cancelled():
+            return
+        self.done += 1
+        self.progress.emit(self.done, len(self.futures))
+
+    def cancel(self):
+        self.batch += 1
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+
+    def shutdown(self):
+        self.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+""" PangoImageCache keeps recently decoded images within a memory budget and
+   decodes the neighbours of the current image ahead of time """
+class PangoImageCache(QObject):
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, budget=512*2**20, workers=2, parent=None):
+        super().__init__(parent)
+        self.images = PangoLRUCache(budget, lambda img: img.sizeInBytes())
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = {}
+        self.current = None
+        self.hits = 0
+        self.misses = 0
+
+    # Non-blocking, a miss is decoded on a worker and announced through loaded
+    def fetch(self, fpath):
+        with self.lock:
+            img = self.images.get(fpath)
+            self.current = fpath
+            if img is None and fpath not in self.pending:
+                self.pending[fpath] = self.executor.submit(self.decode, fpath)
+            if img is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return img
+
+    def decode(self, fpath):
+        if pango_tiled_source(fpath) is not None:
+            return self.store(fpath, QImage()) # Viewer reads its tiles instead
+        return self.store(fpath, pango_read_image(fpath))
+
+    def store(self, fpath, img):
+        with self.lock:
+            if not img.isNull():
+                self.images.put(fpath, img)
+            self.pending.pop(fpath, None)
+        self.loaded.emit(fpath, img)
+        return img
+
+    def prefetch(self, fpaths):
+        with self.lock:
+            for fpath, future in list(self.pending.items()):
+                if fpath not in fpaths and fpath != self.current and future.cancel():
+                    del self.pending[fpath]
+
+            for fpath in fpaths:
+                if fpath not in self.images and fpath not in self.pending:
+                    self.pending[fpath] = self.executor.submit(self.decode, fpath)
+
+    def shutdown(self):
+        self.prefetch([])
+        self.executor.shutdown(wait=False)
+
+def pango_thumbnail_path(fpath):
+    return os.path.join(pango_cache_dir(fpath, "thumbnails"), pango_file_key(fpath)+".png")
+
+# Null unless the thumbnail was already made
+def pango_read_thumbnail(fpath):
+    try:
+        return QImage(pango_thumbnail_path(fpath))
+    except OSError:
+        return QImage()
+
+""" PangoThumbnailCache decodes thumbnails on worker threads and keeps them
+   on disk, so a folder only has to be decoded once """
+class PangoThumbnailCache(QObject):
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, size=QSize(150, 150), workers=2, parent=None):
+        super().__init__(parent)
+        self.size = size
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock() # Guards pending, shared with the workers
+        self.pending = set()
+
+    def request(self, fpath):
+        with self.lock:
+            if fpath in self.pending:
+                return
+            self.pending.add(fpath)
+        self.executor.submit(self.load, fpath)
+
+    def load(self, fpath):
+        try:
+            th_fpath = pango_thumbnail_path(fpath)
+        except OSError:
+            th_fpath = None
+
+        img = QImage(th_fpath) if th_fpath is not None else QImage()
+        if img.isNull():
+            src = pango_tiled_source(fpath)
+            if src is not None:
+                img = pango_source_preview(src, self.size)
+            else:
+                img = pango_read_preview(fpath, self.size)
+            if not img.isNull() and th_fpath is not None:
+                try:
+                    os.makedirs(os.path.dirname(th_fpath), exist_ok=True)
+                    img.save(th_fpath)
+                except OSError: # Read-only folder, the thumbnail is just not kept
+                    pass
+
+        with self.lock:
+            self.pending.discard(fpath)
+        self.loaded.emit(fpath, img)
@@ -1,19 +1,18 @@
 import os
 from ..item import PangoLabelGraphic
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap
+from PyQt5.QtGui import QColor, QImage, QPainter
 
 
 def image_mask_write(interface, fpath, folder):
     pre, ext = os.path.splitext(os.path.basename(fpath))
     fname = pre+".png"
 
-    px = interface.scene.px
+    size = interface.scene.image.size()
     ret_vis = interface.scene.reticle.isVisible()
 
     interface.scene.clearSelection()
-    interface.scene.px = QPixmap(px.size())
-    interface.scene.px.fill(Qt.transparent)
+    interface.scene.image.visible = False
     interface.scene.reticle.setVisible(False)
     for gfx in interface.scene.items():
         if hasattr(gfx, "force_opaque"):
@@ -28,7 +27,7 @@ def image_mask_write(interface, fpath, folder):
 
     interface.scene.invalidate(interface.scene.sceneRect())
 
-    img = QImage(px.size(), QImage.Format_ARGB32)
+    img = QImage(size, QImage.Format_ARGB32)
     img.fill(QColor(0, 0, 0))
 
     painter = QPainter(img)
@@ -43,7 +42,7 @@ def image_mask_write(interface, fpath, folder):
         label.color = saved_colors[row]
         label.force_update()
 
-    interface.scene.px = px
+    interface.scene.image.visible = True
     interface.scene.reticle.setVisible(ret_vis)
     for item in interface.scene.items():
         if hasattr(item, "force_opaque"):
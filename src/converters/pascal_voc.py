@@ -4,18 +4,18 @@ from PyQt5.QtGui import QImage
 from lxml import etree
 
 from ..item import PangoBboxItem, PangoLabelItem, PangoPathItem, PangoPolyItem
-from ..utils import pango_get_palette
+from ..utils import pango_find_image, pango_get_palette
 
 def pascal_voc_write(interface, fpath):
-    items = []
-    for k in interface.map.keys():
-        item = interface.model.itemFromIndex(QModelIndex(k))
-        if hasattr(item, "fpath") and item.fpath == fpath:
-            items.append(item)
+    items = interface.items_for(fpath)
     if items == []:
         return
+    interface.hydrate(fpath)
 
-    img = QImage(fpath)
+    info = interface.scene.metadata.info(fpath)
+    if info is None: # Header not understood, decoded instead
+        img = QImage(fpath)
+        info = {"width": img.width(), "height": img.height(), "depth": (3, 1)[img.isGrayscale()]}
     root = etree.Element("annotation")
 
     etree.SubElement(root, "folder").text = os.path.basename(os.path.dirname(fpath))
@@ -26,9 +26,9 @@ def pascal_voc_write(interface, fpath):
     etree.SubElement(source, "database").text = "Unknown"
 
     size = etree.SubElement(root, "size")
-    etree.SubElement(size, "width").text = str(img.width())
-    etree.SubElement(size, "height").text = str(img.height())
-    etree.SubElement(size, "depth").text = str((3, 1)[img.isGrayscale()])
+    etree.SubElement(size, "width").text = str(info["width"])
+    etree.SubElement(size, "height").text = str(info["height"])
+    etree.SubElement(size, "depth").text = str(info["depth"])
 
     etree.SubElement(root, "segmented").text = "0"
 
@@ -62,12 +62,8 @@ def pascal_voc_read(interface, fpath):
     tree = etree.parse(fpath)
     root = tree.getroot()
 
-    pre, ext = os.path.splitext(fpath)
-    if os.path.exists(pre+".png"):
-        img_fpath = pre+".png"
-    elif os.path.exists(pre+".jpg"):
-        img_fpath = pre+".jpg"
-    else:
+    img_fpath = pango_find_image(fpath)
+    if img_fpath is None:
         return
 
     for object in root.iterfind("object"):
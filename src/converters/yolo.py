@@ -1,17 +1,14 @@
 import os
 
-from PyQt5.QtCore import QModelIndex, QPointF
-from ..utils import pango_get_palette
+from PyQt5.QtCore import QPointF
+from ..utils import pango_find_image, pango_get_palette
 from ..item import PangoLabelItem, PangoBboxItem, PangoPathItem, PangoPolyItem
 
 def yolo_write(interface, fpath):
-    items = []
-    for k in interface.map.keys():
-        item = interface.model.itemFromIndex(QModelIndex(k))
-        if hasattr(item, "fpath") and item.fpath == fpath:
-            items.append(item)
+    items = interface.items_for(fpath)
     if items == []:
         return
+    interface.hydrate(fpath)
 
     pre, ext = os.path.splitext(fpath)
     with open(pre+".txt", 'w') as f:
@@ -29,12 +26,8 @@ def yolo_write(interface, fpath):
                 rect.width(), rect.height()))
 
 def yolo_read(interface, fpath):
-    pre, ext = os.path.splitext(fpath)
-    if os.path.exists(pre+".png"):
-        img_fpath = pre+".png"
-    elif os.path.exists(pre+".jpg"):
-        img_fpath = pre+".jpg"
-    else:
+    img_fpath = pango_find_image(fpath)
+    if img_fpath is None:
         return
 
     with open(fpath, 'r') as f:
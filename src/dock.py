@@ -1,8 +1,13 @@
-from PyQt5.QtCore import QDir, Qt, QSize
-from PyQt5.QtGui import QIcon, QPixmap
-from PyQt5.QtWidgets import (QDockWidget, QFileIconProvider, QFileSystemModel, QListView, QTreeView, QUndoStack, QVBoxLayout, QWidget)
+from array import array
+from bisect import bisect_left, bisect_right
 
-from .utils import pango_get_icon
+from PyQt5 import sip
+from PyQt5.QtCore import QAbstractItemModel, QAbstractProxyModel, QDir, QItemSelectionModel, QModelIndex, QPersistentModelIndex, Qt, QSize
+from PyQt5.QtGui import QColor, QIcon, QPixmap
+from PyQt5.QtWidgets import (QAbstractItemView, QDockWidget, QFileIconProvider, QFileSystemModel, QListView, QTreeView, QUndoCommand, QUndoStack, QVBoxLayout, QWidget)
+
+from .cache import PangoThumbnailCache
+from .utils import pango_get_icon, pango_image_formats, pango_is_image
 
 
 class PangoDockWidget(QDockWidget):
@@ -30,6 +35,225 @@ class PangoLabelWidget(PangoDockWidget):
 
         self.setWidget(self.tree_view)
 
+""" PangoImageTreeModel shows the labels of the item model and, under each,
+   only the shapes of the current image. Those are kept as sorted arrays of
+   source rows rather than persistent indexes, which the item model would
+   otherwise update on every row change, and handed to views in chunks as
+   they scroll to them """
+class PangoImageTreeModel(QAbstractProxyModel):
+    chunk_size = 64
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.fpath = None
+        self.shown = {} # Label key to the source rows of its shown shapes
+        self.fetched = {} # Label key to the number of those given to views
+        self.ids = {} # Label key to the internal id of its shape rows
+        self.labels = {}
+
+    def setSourceModel(self, model):
+        self.beginResetModel()
+        super().setSourceModel(model)
+        model.dataChanged.connect(self.source_data_changed)
+        model.rowsAboutToBeInserted.connect(self.source_rows_inserting)
+        model.rowsInserted.connect(self.source_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self.source_rows_removing)
+        model.rowsRemoved.connect(self.source_rows_removed)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self.source_reset)
+        self.endResetModel()
+
+    def label_key(self, idx):
+        return QPersistentModelIndex(self.sourceModel().index(idx.row(), 0))
+
+    def label_index(self, label_key):
+        return self.createIndex(label_key.row(), 0, 0)
+
+    def label_id(self, label_key):
+        if label_key not in self.ids:
+            self.ids[label_key] = len(self.ids)+1
+            self.labels[self.ids[label_key]] = label_key
+        return self.ids[label_key]
+
+    # Replaces all shape rows, keys may come in any order
+    def set_shapes(self, fpath, keys):
+        self.fpath = fpath
+        lists = {}
+        for key in keys:
+            lists.setdefault(QPersistentModelIndex(key.parent()), []).append(key.row())
+
+        for label_key in list(self.shown)+[k for k in lists if k not in self.shown]:
+            if not label_key.isValid():
+                continue
+            parent = self.label_index(label_key)
+            n = self.fetched.get(label_key, 0)
+            if n > 0:
+                self.beginRemoveRows(parent, 0, n-1)
+                self.fetched[label_key] = 0
+                self.shown[label_key] = array("l")
+                self.endRemoveRows()
+
+            self.shown[label_key] = array("l", sorted(lists.get(label_key, [])))
+            n = min(len(self.shown[label_key]), self.chunk_size)
+            if n > 0:
+                self.beginInsertRows(parent, 0, n-1)
+                self.fetched[label_key] = n
+                self.endInsertRows()
+
+    def show(self, key):
+        label_key = QPersistentModelIndex(key.parent())
+        rows = self.shown.setdefault(label_key, array("l"))
+        pos = bisect_left(rows, key.row())
+        if pos < len(rows) and rows[pos] == key.row():
+            return
+        n = self.fetched.get(label_key, 0)
+        if pos < n or n == len(rows):
+            self.beginInsertRows(self.label_index(label_key), pos, pos)
+            rows.insert(pos, key.row())
+            self.fetched[label_key] = n+1
+            self.endInsertRows()
+        else:
+            rows.insert(pos, key.row())
+
+    def hide(self, key):
+        label_key = QPersistentModelIndex(key.parent())
+        rows = self.shown.get(label_key, array("l"))
+        pos = bisect_left(rows, key.row())
+        if pos == len(rows) or rows[pos] != key.row():
+            return
+        n = self.fetched.get(label_key, 0)
+        if pos < n:
+            self.beginRemoveRows(self.label_index(label_key), pos, pos)
+            del rows[pos]
+            self.fetched[label_key] = n-1
+            self.endRemoveRows()
+        else:
+            del rows[pos]
+
+    # Rows at or past first move by count
+    def shift_rows(self, rows, first, count):
+        lo = bisect_left(rows, first)
+        rows[lo:] = array("l", [row+count for row in rows[lo:]])
+
+    def source_data_changed(self, top_idx, bottom_idx, roles):
+        for row in range(top_idx.row(), bottom_idx.row()+1):
+            idx = self.mapFromSource(top_idx.sibling(row, 0))
+            if idx.isValid():
+                self.dataChanged.emit(idx, idx, roles)
+
+    def source_rows_inserting(self, parent, first, last):
+        if not parent.isValid():
+            self.beginInsertRows(QModelIndex(), first, last)
+
+    def source_rows_inserted(self, parent, first, last):
+        if not parent.isValid():
+            self.endInsertRows()
+        elif QPersistentModelIndex(parent) in self.shown:
+            self.shift_rows(self.shown[QPersistentModelIndex(parent)], first, last-first+1)
+
+    # Shapes leave their rows before the source drops them
+    def source_rows_removing(self, parent, first, last):
+        if not parent.isValid():
+            self.beginRemoveRows(QModelIndex(), first, last)
+            return
+        label_key = QPersistentModelIndex(parent)
+        rows = self.shown.get(label_key, array("l"))
+        lo = bisect_left(rows, first)
+        hi = bisect_right(rows, last)
+        n = self.fetched.get(label_key, 0)
+        if lo < min(hi, n):
+            self.beginRemoveRows(self.label_index(label_key), lo, min(hi, n)-1)
+            self.fetched[label_key] = n-(min(hi, n)-lo)
+            del rows[lo:hi]
+            self.endRemoveRows()
+        else:
+            del rows[lo:hi]
+
+    def source_rows_removed(self, parent, first, last):
+        if not parent.isValid():
+            for label_key in [k for k in self.ids if not k.isValid()]:
+                del self.labels[self.ids.pop(label_key)]
+            for label_key in [k for k in self.shown if not k.isValid()]:
+                del self.shown[label_key]
+                self.fetched.pop(label_key, None)
+            self.endRemoveRows()
+        elif QPersistentModelIndex(parent) in self.shown:
+            self.shift_rows(self.shown[QPersistentModelIndex(parent)], last+1, first-last-1)
+
+    def source_reset(self):
+        self.shown.clear()
+        self.fetched.clear()
+        self.ids.clear()
+        self.labels.clear()
+        self.endResetModel()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not parent.isValid():
+            if 0 <= row < self.sourceModel().rowCount() and 0 <= column < self.columnCount():
+                return self.createIndex(row, column, 0)
+        elif parent.internalId() == 0:
+            label_key = self.label_key(parent)
+            if 0 <= row < self.fetched.get(label_key, 0) and 0 <= column < self.columnCount():
+                return self.createIndex(row, column, self.label_id(label_key))
+        return QModelIndex()
+
+    def parent(self, idx):
+        if not idx.isValid() or idx.internalId() == 0:
+            return QModelIndex()
+        return self.label_index(self.labels[idx.internalId()])
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self.sourceModel().rowCount()
+        if parent.internalId() == 0 and parent.column() == 0:
+            return self.fetched.get(self.label_key(parent), 0)
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return self.sourceModel().columnCount()
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return self.rowCount() > 0
+        if parent.internalId() == 0 and parent.column() == 0:
+            return len(self.shown.get(self.label_key(parent), [])) > 0
+        return False
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or parent.internalId() != 0:
+            return False
+        label_key = self.label_key(parent)
+        return self.fetched.get(label_key, 0) < len(self.shown.get(label_key, []))
+
+    def fetchMore(self, parent):
+        label_key = self.label_key(parent)
+        n = self.fetched.get(label_key, 0)
+        m = min(len(self.shown.get(label_key, [])), n+self.chunk_size)
+        if m > n:
+            self.beginInsertRows(parent, n, m-1)
+            self.fetched[label_key] = m
+            self.endInsertRows()
+
+    def mapToSource(self, idx):
+        if not idx.isValid():
+            return QModelIndex()
+        if idx.internalId() == 0:
+            return self.sourceModel().index(idx.row(), idx.column())
+        label_key = self.labels[idx.internalId()]
+        return self.sourceModel().index(self.shown[label_key][idx.row()], idx.column(), QModelIndex(label_key))
+
+    def mapFromSource(self, idx):
+        if not idx.isValid():
+            return QModelIndex()
+        if not idx.parent().isValid():
+            return self.createIndex(idx.row(), idx.column(), 0)
+        label_key = QPersistentModelIndex(idx.parent())
+        rows = self.shown.get(label_key, array("l"))
+        pos = bisect_left(rows, idx.row())
+        if pos < self.fetched.get(label_key, 0) and rows[pos] == idx.row():
+            return self.createIndex(pos, idx.column(), self.label_id(label_key))
+        return QModelIndex()
+
 class PangoUndoWidget(PangoDockWidget):
     def __init__(self, title, undo_view, parent=None):
         super().__init__(title, parent)
@@ -74,16 +298,294 @@ class PangoUndoWidget(PangoDockWidget):
     #        return QSize(16, 24)
 
 
+""" PangoUndoModel lists the commands of an undo stack, consecutive strokes or
+   drags on one shape are grouped under a row. Rows only hold stack positions,
+   command text is read from the stack when a row is shown """
+class PangoUndoModel(QAbstractItemModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.stack = None
+        self.marks = [] # Identifies each command of the stack
+        self.keys = []
+        self.groups = [] # First command of each row
+        self.clean_icon = QIcon()
+        self.empty_label = "<empty>"
+
+    def set_stack(self, stack):
+        if self.stack is not None and not sip.isdeleted(self.stack):
+            self.stack.indexChanged.disconnect(self.stack_changed)
+            self.stack.canRedoChanged.disconnect(self.stack_changed)
+        self.stack = stack
+        if self.stack is not None:
+            self.stack.indexChanged.connect(self.stack_changed)
+            self.stack.canRedoChanged.connect(self.stack_changed) # Macros drop redo commands silently
+
+        self.beginResetModel()
+        self.marks = []
+        self.keys = []
+        self.groups = []
+        self.extend(0)
+        self.endResetModel()
+
+    # Macros are owned by Qt, their wrappers can outlive them, so they are
+    # told apart by their first child. One opened empty is marked None, and
+    # taken for whichever macro is at its position later
+    def mark(self, com):
+        if type(com) is not QUndoCommand:
+            return com
+        return com.child(0) if com.childCount() > 0 else None
+
+    def same(self, i, com):
+        if self.marks[i] is None:
+            return type(com) is QUndoCommand
+        return self.marks[i] is self.mark(com)
+
+    # Consecutive commands on the same shape share a row. Macros, like path
+    # strokes, go by their first child, so only once they are closed
+    def group_key(self, com):
+        if type(com) is QUndoCommand and com.childCount() > 0:
+            com = com.child(0)
+        if hasattr(com, "gfx"):
+            return type(com), com.gfx
+        return None
+
+    def group_range(self, g):
+        end = self.groups[g+1] if g+1 < len(self.groups) else len(self.marks)
+        return self.groups[g], end
+
+    def extend(self, start):
+        for i in range(start, self.stack.count() if self.stack is not None else 0):
+            com = self.stack.command(i)
+            key = self.group_key(com)
+            if not self.keys or key is None or key != self.keys[-1]:
+                self.groups.append(i)
+            self.marks.append(self.mark(com))
+            self.keys.append(key)
+
+    # Most changes touch the end of the stack: a push, a merge or truncated
+    # redo commands, so only rows past the last unchanged command are redone
+    def stack_changed(self):
+        if sip.isdeleted(self.stack):
+            return
+        n = self.stack.count()
+        if n > 0 and len(self.marks) > 1 and not self.same(0, self.stack.command(0))\
+                and self.same(1, self.stack.command(0)):
+            self.drop_first() # Over the undo limit
+
+        keep = min(len(self.marks), n)
+        while keep > 0 and not self.same(keep-1, self.stack.command(keep-1)):
+            keep -= 1
+
+        if n-keep > 1:
+            self.beginResetModel()
+            del self.marks[keep:]
+            del self.keys[keep:]
+            self.groups = [g for g in self.groups if g < keep]
+            self.extend(keep)
+            self.endResetModel()
+            return
+
+        if keep < len(self.marks):
+            self.truncate(keep)
+        if keep < n:
+            self.append(self.stack.command(keep))
+        elif n > 0 and self.keys[n-1] != self.group_key(self.stack.command(n-1)):
+            self.truncate(n-1) # A macro closed, it may join the previous row
+            self.append(self.stack.command(n-1))
+        elif n > 0: # Merged into
+            idx = self.index_for(n)
+            self.dataChanged.emit(idx, idx, [Qt.DisplayRole])
+            if idx.parent().isValid():
+                self.dataChanged.emit(idx.parent(), idx.parent(), [Qt.DisplayRole])
+
+    def drop_first(self):
+        start, end = self.group_range(0)
+        if end-start == 1:
+            self.beginRemoveRows(QModelIndex(), 1, 1)
+            self.groups = [g-1 for g in self.groups[1:]]
+        else:
+            self.beginRemoveRows(self.index(1, 0), 0, 1 if end-start == 2 else 0)
+            self.groups = [0]+[g-1 for g in self.groups[1:]]
+        del self.marks[0]
+        del self.keys[0]
+        self.endRemoveRows()
+
+    def truncate(self, keep):
+        g = bisect_right(self.groups, keep-1)-1 if keep > 0 else -1
+        if g+1 < len(self.groups):
+            self.beginRemoveRows(QModelIndex(), g+2, len(self.groups))
+            del self.marks[self.groups[g+1]:]
+            del self.keys[self.groups[g+1]:]
+            del self.groups[g+1:]
+            self.endRemoveRows()
+
+        if g >= 0 and keep < len(self.marks):
+            start, end = self.group_range(g)
+            first = keep-start if keep-start > 1 else 0
+            self.beginRemoveRows(self.index(g+1, 0), first, end-start-1)
+            del self.marks[keep:]
+            del self.keys[keep:]
+            self.endRemoveRows()
+            self.dataChanged.emit(self.index(g+1, 0), self.index(g+1, 0), [Qt.DisplayRole])
+
+    def append(self, com):
+        key = self.group_key(com)
+        if self.keys and key is not None and key == self.keys[-1]:
+            g = len(self.groups)-1
+            size = len(self.marks)-self.groups[g]
+            self.beginInsertRows(self.index(g+1, 0), size if size > 1 else 0, size)
+            self.marks.append(self.mark(com))
+            self.keys.append(key)
+            self.endInsertRows()
+            self.dataChanged.emit(self.index(g+1, 0), self.index(g+1, 0), [Qt.DisplayRole])
+        else:
+            self.beginInsertRows(QModelIndex(), len(self.groups)+1, len(self.groups)+1)
+            self.groups.append(len(self.marks))
+            self.marks.append(self.mark(com))
+            self.keys.append(key)
+            self.endInsertRows()
+
+    # Stack position reached by selecting a row
+    def stack_index(self, idx):
+        if idx.internalId() != 0:
+            return self.groups[idx.internalId()-1]+idx.row()+1
+        elif idx.row() == 0:
+            return 0
+        return self.group_range(idx.row()-1)[1]
+
+    def index_for(self, stack_index, grouped=False):
+        if stack_index == 0 or not self.marks:
+            return self.index(0, 0)
+        g = bisect_right(self.groups, stack_index-1)-1
+        start, end = self.group_range(g)
+        if end-start == 1 or grouped:
+            return self.index(g+1, 0)
+        return self.index(stack_index-1-start, 0, self.index(g+1, 0))
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, parent.row() if parent.isValid() else 0)
+
+    def parent(self, idx):
+        if not idx.isValid() or idx.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(idx.internalId(), 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if self.stack is None:
+            return 0
+        elif not parent.isValid():
+            return len(self.groups)+1
+        elif parent.internalId() != 0 or parent.row() == 0:
+            return 0
+        start, end = self.group_range(parent.row()-1)
+        return end-start if end-start > 1 else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def data(self, idx, role=Qt.DisplayRole):
+        if not idx.isValid():
+            return None
+        first, last = self.stack_index(idx)-1, self.stack_index(idx)-1
+        if idx.internalId() == 0 and idx.row() > 0:
+            first = self.groups[idx.row()-1]
+
+        if role == Qt.DisplayRole:
+            if idx.internalId() == 0 and idx.row() == 0:
+                return self.empty_label
+            elif last >= self.stack.count():
+                return None
+            elif last > first:
+                return self.stack.command(last).text()+" ("+str(last-first+1)+" steps)"
+            return self.stack.command(last).text()
+        elif role == Qt.DecorationRole:
+            if first <= self.stack.cleanIndex()-1 <= last:
+                return self.clean_icon
+        elif role == Qt.ForegroundRole:
+            if first >= self.stack.index(): # Undone
+                return QColor(Qt.gray)
+        return None
+
+""" PangoUndoView is a drop-in for QUndoView, over a PangoUndoModel """
+class PangoUndoView(QTreeView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.undo_model = PangoUndoModel(self)
+        self.syncing = False
+
+        # Rows moving under the current one must not move the stack. Before
+        # the selection model is connected, which moves the current row
+        self.undo_model.rowsAboutToBeRemoved.connect(self.begin_sync)
+        self.undo_model.rowsRemoved.connect(self.select_current)
+        self.undo_model.modelAboutToBeReset.connect(self.begin_sync)
+        self.undo_model.modelReset.connect(self.select_current)
+
+        self.setModel(self.undo_model)
+        self.setHeaderHidden(True)
+        self.setUniformRowHeights(True) # Only visible rows are measured
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.selectionModel().currentChanged.connect(self.row_changed)
+
+    def setStack(self, stack):
+        if self.undo_model.stack is not None and not sip.isdeleted(self.undo_model.stack):
+            self.undo_model.stack.indexChanged.disconnect(self.select_current)
+            self.undo_model.stack.cleanChanged.disconnect(self.select_current)
+        self.undo_model.set_stack(stack)
+        if stack is not None:
+            stack.indexChanged.connect(self.select_current)
+            stack.cleanChanged.connect(self.select_current)
+        self.select_current()
+
+    def stack(self):
+        return self.undo_model.stack
+
+    def setCleanIcon(self, icon):
+        self.undo_model.clean_icon = icon
+        self.viewport().update()
+
+    def cleanIcon(self):
+        return self.undo_model.clean_icon
+
+    def setEmptyLabel(self, label):
+        self.undo_model.empty_label = label
+        self.viewport().update()
+
+    def emptyLabel(self):
+        return self.undo_model.empty_label
+
+    def begin_sync(self, *args):
+        self.syncing = True
+
+    def select_current(self, *args):
+        self.syncing = True
+        if self.stack() is not None and not sip.isdeleted(self.stack()):
+            idx = self.undo_model.index_for(self.stack().index(), grouped=True)
+            if idx.row() > 0 and self.isExpanded(idx):
+                idx = self.undo_model.index_for(self.stack().index())
+
+            self.selectionModel().setCurrentIndex(idx, QItemSelectionModel.ClearAndSelect)
+            self.scrollTo(idx)
+            self.viewport().update() # Undone rows are greyed out
+        self.syncing = False
+
+    def row_changed(self, c_idx, p_idx):
+        if not self.syncing and c_idx.isValid() and self.stack() is not None:
+            self.stack().setIndex(self.undo_model.stack_index(c_idx))
+
+
 class PangoFileWidget(PangoDockWidget):
     def __init__(self, title, parent=None):
         super().__init__(title, parent)
         self.setFixedWidth(160)
 
-        self.file_model = QFileSystemModel()
+        self.file_model = PangoFileSystemModel()
         self.file_model.setFilter(QDir.Files | QDir.NoDotAndDotDot)
-        self.file_model.setNameFilters(["*.jpg", "*.png"])
+        self.file_model.setNameFilters(["*"+ext for ext in pango_image_formats])
         self.file_model.setNameFilterDisables(False)
         self.th_provider = ThumbnailProvider()
+        self.th_provider.cache.loaded.connect(self.thumbnail_loaded)
         self.file_model.setIconProvider(self.th_provider)
 
         self.file_view = QListView()
@@ -91,9 +593,16 @@ class PangoFileWidget(PangoDockWidget):
         self.file_view.setViewMode(QListView.IconMode)
         self.file_view.setFlow(QListView.LeftToRight)
         self.file_view.setIconSize(QSize(150, 150))
+        self.file_view.setUniformItemSizes(True) # Only visible thumbnails are requested
         
         self.setWidget(self.file_view)
 
+    def thumbnail_loaded(self, fpath, img):
+        self.th_provider.set_thumbnail(fpath, img)
+        idx = self.file_model.index(fpath)
+        if idx.isValid():
+            self.file_model.dataChanged.emit(idx, idx, [Qt.DecorationRole])
+
     def select_next_image(self):
         c_idx = self.file_view.currentIndex()
         idx = c_idx.siblingAtRow(c_idx.row()+1)
@@ -106,17 +615,51 @@ class PangoFileWidget(PangoDockWidget):
         if idx.row() != -1:
             self.file_view.setCurrentIndex(idx)
 
+    # Nearest first, in file view order
+    def neighbour_fpaths(self, n):
+        c_idx = self.file_view.currentIndex()
+        fpaths = []
+        for d in range(1, n+1):
+            for row in (c_idx.row()+d, c_idx.row()-d):
+                idx = c_idx.siblingAtRow(row)
+                if idx.row() != -1:
+                    fpaths.append(self.file_model.filePath(idx))
+        return fpaths
+
+class PangoFileSystemModel(QFileSystemModel):
+    def data(self, idx, role=Qt.DisplayRole):
+        provider = self.iconProvider()
+        if role == Qt.DecorationRole and idx.column() == 0 and type(provider) is ThumbnailProvider:
+            fpath = self.filePath(idx)
+            if pango_is_image(fpath):
+                return provider.thumbnail(fpath)
+        return super().data(idx, role)
+
 class ThumbnailProvider(QFileIconProvider):
     def __init__(self):
         super().__init__()
+        self.cache = PangoThumbnailCache()
+        self.thumbnails = {}
 
-    def icon(self, type: 'QFileIconProvider.IconType'):
-        fn = type.filePath()
+        px = QPixmap(self.cache.size)
+        px.fill(QColor(128, 128, 128, 40))
+        self.placeholder = QIcon(px)
 
-        if fn.endswith(".jpg") or fn.endswith(".png"):
-            th = QPixmap(QSize(100, 100))
-            th = th.scaledToHeight(125, Qt.FastTransformation)
-            th.load(fn)
-            return QIcon(th)
+    # Called from the model's gatherer thread, images get thumbnails through the model
+    def icon(self, type: 'QFileIconProvider.IconType'):
+        if type.isFile() and pango_is_image(type.filePath()):
+            return QIcon()
         else:
             return super().icon(type)
+
+    def thumbnail(self, fpath):
+        if fpath not in self.thumbnails:
+            self.cache.request(fpath)
+            return self.placeholder
+        return self.thumbnails[fpath]
+
+    def set_thumbnail(self, fpath, img):
+        if img.isNull():
+            self.thumbnails[fpath] = self.placeholder
+        else:
+            self.thumbnails[fpath] = QIcon(QPixmap.fromImage(img))
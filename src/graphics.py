@@ -1,75 +1,204 @@
-from PyQt5.QtCore import QEvent, QLineF, QPointF, QRectF, Qt, pyqtSignal
-from PyQt5.QtGui import QPen, QPixmap, QTransform
+from array import array
+from collections import OrderedDict
+
+from PyQt5 import sip
+from PyQt5.QtCore import QEvent, QLineF, QPointF, QRectF, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QPainterPath, QPen
 from PyQt5.QtWidgets import (QAction, QGraphicsEllipseItem, QGraphicsItem, QGraphicsScene, QGraphicsView, QMenu, QUndoCommand, QUndoCommand, QUndoStack)
 
-from .item import PangoBboxGraphic, PangoGraphic, PangoPathGraphic, PangoPolyGraphic
+from .cache import PangoImageCache, PangoMetadataCache, pango_read_thumbnail
+from .image import PangoQImageSource, PangoTiledImage
+from .raster import pango_tiled_source
+from .spatial import PangoHandleIndex, pango_corners
+from .item import PangoBboxGraphic, PangoGraphic, PangoLabelGraphic, PangoPathGraphic, PangoPolyGraphic, PangoRenderContext
 from .utils import pango_get_icon
 
 class PangoGraphicsScene(QGraphicsScene):
     gfx_changed = pyqtSignal(PangoGraphic, QGraphicsItem.GraphicsItemChange)
     gfx_removed = pyqtSignal(PangoGraphic)
+    stack_compacted = pyqtSignal(str, QUndoStack)
     clear_tool = pyqtSignal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self.change_stacks = {}
+        self.undo_limit = 500 # Top-level commands per image
+        self.history_budget = 20000 # Commands over all images
         self.stack = QUndoStack()
         self.fpath = None
-        self.px = QPixmap()
+        self.image = PangoTiledImage()
+        self.context = PangoRenderContext()
+        self.image_cache = PangoImageCache()
+        self.image_cache.loaded.connect(self.image_loaded)
+        self.metadata = PangoMetadataCache()
         self.active_label = PangoGraphic()
         self.active_com = CreateShape(PangoGraphic, QPointF(), PangoGraphic())
 
         self.tool = None
         self.tool_size = 10
+        self.composite_labels = True
+        self.merge_strokes = True
+        self.drag_com = None
+        self.commands = {}
+        self.draft = False
+        self.handle_radius = 20
+        self.park_limit = 0 # Recent images whose shapes stay in the scene
 
         self.full_clear()
 
     def full_clear(self):
+        self.drag_com = None
+        self.handles = PangoHandleIndex()
+        self.parked = OrderedDict()
         self.stack.clear()
+        self.prune_commands()
         self.clear()
         self.init_reticle()
         self.reset_com()
         self.clear_tool.emit()
 
+    # Keeps the outgoing image parked, returns the images that fall out
+    def park(self, new_fpath, old_fpath):
+        self.parked.pop(new_fpath, None)
+        if self.park_limit > 0 and old_fpath is not None and old_fpath != new_fpath:
+            self.parked[old_fpath] = True
+            self.parked.move_to_end(old_fpath)
+        evicted = []
+        while len(self.parked) > self.park_limit:
+            evicted.append(self.parked.popitem(last=False)[0])
+        return evicted
+
+    def set_composite_labels(self, on):
+        self.composite_labels = on
+        for gfx in self.items():
+            if type(gfx) is PangoLabelGraphic:
+                gfx.set_mode()
+
     def init_reticle(self):
         self.reticle = QGraphicsEllipseItem(-5, -5, 10, 10)
         self.reticle.setVisible(False)
         self.reticle.setPen(QPen(Qt.NoPen))
         self.addItem(self.reticle)
 
+    # Layout only needs the header, pixels follow from the image cache
     def set_fpath(self, fpath):
         self.fpath = fpath
-        self.px = QPixmap(self.fpath)
-        self.setSceneRect(QRectF(self.px.rect()))
+        src = pango_tiled_source(fpath)
+        if src is None:
+            img = self.image_cache.fetch(fpath)
+            if img is not None:
+                src = PangoQImageSource(img)
+
+        if src is not None:
+            self.image.set_source(src)
+        else: # Decoded on a worker, a thumbnail made earlier stands in
+            self.image.set_preview(pango_read_thumbnail(fpath), self.metadata.size(fpath))
+        self.context.set_size(self.image.size())
+        self.setSceneRect(self.image.rect())
+
+    def image_loaded(self, fpath, img):
+        if fpath != self.fpath or self.image.source is not None:
+            return
+        src = pango_tiled_source(fpath) if img.isNull() else PangoQImageSource(img)
+        if src is not None:
+            sized = self.image.size().isValid()
+            self.image.set_source(src)
+            if not sized: # The header didn't tell
+                self.context.set_size(self.image.size())
+                self.setSceneRect(self.image.rect())
+                for view in self.views():
+                    view.fitInView(self.sceneRect(), Qt.KeepAspectRatio)
+            self.invalidate(self.sceneRect(), QGraphicsScene.BackgroundLayer)
 
     def drawBackground(self, painter, rect):
-        painter.drawPixmap(0, 0, self.px)
+        self.image.draw(painter, rect, self.draft)
+
+    def begin_drag(self, com):
+        self.end_drag()
+        self.drag_com = com
+        self.active_com = com
+
+    # One command for the whole drag
+    def end_drag(self):
+        com, self.drag_com = self.drag_com, None
+        if com is not None and com.pos != com.old_pos:
+            self.push(com)
 
     def reset_com(self):
+        self.end_drag()
+        self.active_com.gfx.settle_geometry()
         if type(self.active_com.gfx) is PangoPolyGraphic:
             if not self.active_com.gfx.poly.isClosed():
                 self.unravel_shapes(self.active_com.gfx)
         self.active_com = CreateShape(PangoGraphic, QPointF(), PangoGraphic())
 
-    # Undo all commands for shapes (including creation)
+    # Most recently used stacks are kept last
+    def stack_for(self, fpath):
+        stack = self.change_stacks.pop(fpath, None)
+        if stack is None:
+            stack = QUndoStack()
+            stack.setUndoLimit(self.undo_limit)
+        self.change_stacks[fpath] = stack
+        self.compact_stacks()
+        return stack
+
+    # Over budget, the saved histories of the least recently used images are
+    # handed over through stack_compacted, to be kept packed, and cleared
+    def compact_stacks(self):
+        total = sum(stack.count() for stack in self.change_stacks.values())
+        for fpath, stack in list(self.change_stacks.items())[:-1]:
+            if total <= self.history_budget:
+                break
+            if stack.count() > 0 and stack.isClean():
+                total -= stack.count()
+                self.stack_compacted.emit(fpath, stack)
+                stack.clear()
+        self.prune_commands()
+
+    # Indexes commands per shape, with their top-level command (a macro, if
+    # one is open). Macros are deleted by Qt unnoticed, so they are only
+    # touched through a command of theirs that is still alive
+    def push(self, com):
+        self.stack.push(com)
+        if not sip.isdeleted(com): # Not merged into the previous command
+            top = self.stack.command(self.stack.count()-1)
+            self.commands.setdefault(com.gfx, []).append((self.stack, com, top))
+
+    # Drops deleted commands from the index. A dropped creation is kept, so
+    # unravelling the shape still removes it
+    def prune_commands(self):
+        for gfx, coms in list(self.commands.items()):
+            created = [c for c in coms[:1] if sip.isdeleted(c[1]) and type(c[1]) is CreateShape]
+            coms = created+[c for c in coms if not sip.isdeleted(c[1])]
+            if coms:
+                self.commands[gfx] = coms
+            else:
+                del self.commands[gfx]
+
+    # Undo all commands for shapes (including creation), through the index
+    # so unrelated history is never replayed
     def unravel_shapes(self, *gfxs):
-        for stack in self.change_stacks.values():
-            for i in range(stack.count()-1, -1, -1):
-                com = stack.command(i)
-                if type(com) is QUndoCommand:
-                    for j in range(0, com.childCount()):
-                        sub_com = com.child(j)
-                        if sub_com.gfx in gfxs:
-                            com.setObsolete(True)
-                else:
-                    if com.gfx in gfxs:
-                        com.setObsolete(True)
-
-                    if type(com) == CreateShape:
-                        break # Reached shape creation
-
-            stack.setIndex(0)
-            stack.setIndex(stack.count())
+        stacks = []
+        for gfx in gfxs:
+            for stack, com, top in reversed(self.commands.pop(gfx, [])):
+                if sip.isdeleted(com):
+                    if type(com) is CreateShape:
+                        com.remove_shape() # Dropped from a bounded history
+                    continue
+                elif com.isObsolete():
+                    continue
+                if getattr(com, "applied", False):
+                    com.undo()
+                com.setObsolete(True)
+                if all(top.child(i).isObsolete() for i in range(0, top.childCount())):
+                    top.setObsolete(True)
+                if stack not in stacks:
+                    stacks.append(stack)
+
+        # Obsolete commands are dropped once undone, those on top right away
+        for stack in stacks:
+            while 0 < stack.index() == stack.count() and stack.command(stack.index()-1).isObsolete():
+                stack.undo()
         self.active_com = CreateShape(PangoGraphic, QPointF(), PangoGraphic())
 
     def event(self, event):
@@ -86,50 +215,24 @@ class PangoGraphicsScene(QGraphicsScene):
 
     def select_handler(self, event):
         if event.type() == QEvent.GraphicsSceneMousePress and event.buttons() & Qt.LeftButton:
-            gfx = self.itemAt(event.scenePos(), QTransform())
-            if type(gfx) is PangoPolyGraphic:
-                min_dx = float("inf")
-                for i in range(0, gfx.poly.count()):
-                    dx = QLineF(gfx.poly.value(i), event.scenePos()).length()
-                    if dx < min_dx:
-                        min_dx = dx
-                        idx = i
-
-                if min_dx < 20:
-                    self.active_com = MoveShape(event.scenePos(), gfx, idx=idx)
-                    self.stack.push(self.active_com)        
-
-            elif type(gfx) is PangoBboxGraphic:
-                min_dx = float("inf")
-                for corner in ["topLeft", "topRight", "bottomLeft", "bottomRight"]:
-                    dx = QLineF(getattr(gfx.rect, corner)(), event.scenePos()).length()
-                    if dx < min_dx:
-                        min_dx = dx
-                        min_corner = corner
-
-                if min_dx < 20:
-                    self.active_com = MoveShape(event.scenePos(), gfx, corner=min_corner)
-                    self.stack.push(self.active_com)        
+            handle = self.handles.nearest(event.scenePos(), self.handle_radius)
+            if handle is not None:
+                gfx, key = handle
+                if type(gfx) is PangoPolyGraphic:
+                    self.begin_drag(MoveShape(event.scenePos(), gfx, idx=key))
+                elif type(gfx) is PangoBboxGraphic:
+                    self.begin_drag(MoveShape(event.scenePos(), gfx, corner=key))
 
         elif event.type() == QEvent.GraphicsSceneMouseMove and event.buttons() & Qt.LeftButton:
-            if type(self.active_com) is MoveShape:
-                if type(self.active_com.gfx) is PangoPolyGraphic: 
-                    self.stack.undo()
-                    self.active_com.pos = event.scenePos()
-                    self.stack.redo()
-
-                elif type(self.active_com.gfx) is PangoBboxGraphic: 
-                    self.stack.undo()
-                    old_pos = self.active_com.pos
-                    self.active_com.pos = event.scenePos()
-                    self.stack.redo()
-
-                    tl = self.active_com.gfx.rect.topLeft()
-                    br = self.active_com.gfx.rect.bottomRight()
+            if self.drag_com is not None:
+                old_pos = self.drag_com.pos
+                self.drag_com.drag(event.scenePos())
+
+                if type(self.drag_com.gfx) is PangoBboxGraphic: 
+                    tl = self.drag_com.gfx.rect.topLeft()
+                    br = self.drag_com.gfx.rect.bottomRight()
                     if tl.x() > br.x() or tl.y() > br.y():
-                        self.stack.undo()
-                        self.active_com.pos = old_pos
-                        self.stack.redo()
+                        self.drag_com.drag(old_pos)
 
         elif event.type() == QEvent.GraphicsSceneMouseRelease:
             self.reset_com()
@@ -138,27 +241,28 @@ class PangoGraphicsScene(QGraphicsScene):
         if event.type() == QEvent.GraphicsSceneMousePress:
             if type(self.active_com.gfx) is not PangoPathGraphic:
                 self.active_com = CreateShape(PangoPathGraphic, event.scenePos(), self.active_label)
-                self.stack.push(self.active_com)
+                self.push(self.active_com)
 
             self.stack.beginMacro("Extended "+self.active_com.gfx.name)
             self.active_com = ExtendShape(event.scenePos(), self.active_com.gfx, "moveTo")
-            self.stack.push(self.active_com)
+            self.push(self.active_com)
 
         elif event.type() == QEvent.GraphicsSceneMouseMove:
             self.reticle.setPos(event.scenePos())
             if event.buttons() & Qt.LeftButton:
                 if type(self.active_com.gfx) is PangoPathGraphic:
                     self.active_com = ExtendShape(event.scenePos(), self.active_com.gfx, "lineTo")
-                    self.stack.push(self.active_com)
+                    self.push(self.active_com)
 
         elif event.type() == QEvent.GraphicsSceneMouseRelease:
             self.stack.endMacro()
+            self.active_com.gfx.settle_geometry()
 
     def poly_handler(self, event):
         if event.type() == QEvent.GraphicsSceneMousePress:
             if type(self.active_com.gfx) is not PangoPolyGraphic:
                 self.active_com = CreateShape(PangoPolyGraphic, event.scenePos(), self.active_label)
-                self.stack.push(self.active_com)
+                self.push(self.active_com)
 
             gfx = self.active_com.gfx
             pos = event.scenePos()
@@ -169,7 +273,7 @@ class PangoGraphicsScene(QGraphicsScene):
                     pos.setY(gfx.poly.first().y())
 
                 self.active_com = ExtendShape(pos, self.active_com.gfx)
-                self.stack.push(self.active_com)
+                self.push(self.active_com)
 
                 if gfx.poly.count() > 1 and gfx.poly.isClosed():
                     self.reset_com()
@@ -179,25 +283,24 @@ class PangoGraphicsScene(QGraphicsScene):
             if type(self.active_com.gfx) is not PangoBboxGraphic:
                 self.active_com = CreateShape(PangoBboxGraphic, event.scenePos(), self.active_label)
                 self.stack.beginMacro(self.active_com.text())
-                self.stack.push(self.active_com)
+                self.push(self.active_com)
 
                 self.active_com = MoveShape(event.scenePos(), self.active_com.gfx, corner="topLeft")
-                self.stack.push(self.active_com)        
-                self.active_com = MoveShape( event.scenePos(), self.active_com.gfx, corner="bottomRight")
-                self.stack.push(self.active_com)        
+                self.push(self.active_com)        
+                self.begin_drag(MoveShape(event.scenePos(), self.active_com.gfx, corner="bottomRight"))
+                self.drag_com.drag(event.scenePos())
 
         elif event.type() == QEvent.GraphicsSceneMouseMove:
             if event.buttons() & Qt.LeftButton:  
-                if type(self.active_com.gfx) is PangoBboxGraphic:
-                    tl = self.active_com.gfx.rect.topLeft()
+                if self.drag_com is not None and type(self.drag_com.gfx) is PangoBboxGraphic:
+                    tl = self.drag_com.gfx.rect.topLeft()
                     br = event.scenePos()
                     if tl.x() < br.x() and tl.y() < br.y():
-                        self.active_com = MoveShape(
-                                event.scenePos(), self.active_com.gfx, corner="bottomRight")
-                        self.stack.push(self.active_com)        
+                        self.drag_com.drag(event.scenePos())
 
         elif event.type() == QEvent.GraphicsSceneMouseRelease:
             if type(self.active_com.gfx) is PangoBboxGraphic:
+                self.end_drag()
                 self.stack.endMacro()
                 tl = self.active_com.gfx.rect.topLeft()
                 br = self.active_com.gfx.rect.bottomRight()
@@ -206,37 +309,52 @@ class PangoGraphicsScene(QGraphicsScene):
                 self.reset_com()
 
 class CreateShape(QUndoCommand):
-    def __init__(self, clss, pos, p_gfx):
+    def __init__(self, clss, pos, p_gfx, gfx=None):
         super().__init__()
         self.clss = clss
         self.pos = pos
         self.p_gfx = p_gfx
+        self.restored = False
         self.fpath = ""
         if self.p_gfx.scene() is not None:
             self.fpath += p_gfx.scene().fpath # Create copy
 
-        self.gfx = self.clss()
-        self.setText("Created "+self.shape_name()+" at "+self.shape_coords())
+        self.gfx = self.clss() if gfx is None else gfx
 
-        if clss is PangoPathGraphic:
+        if clss is PangoPathGraphic and gfx is None:
             self.gfx.path.width = self.p_gfx.scene().tool_size
 
     def redo(self):
-        self.gfx.setParentItem(self.p_gfx)
-        self.gfx.inherit_color()
+        if self.isObsolete():
+            return
+        self.applied = True
+        if self.restored: # Pushed from a saved history, already applied
+            return
         self.gfx.name = self.shape_name()+" at "+self.shape_coords()
         self.gfx.fpath = self.fpath
         self.gfx.visible = True
+        self.gfx.setParentItem(self.p_gfx) # Model item is made with the above
+        self.gfx.inherit_color()
 
         self.gfx.scene().clearSelection()
         self.gfx.setSelected(True)
 
     def undo(self):
+        if self.isObsolete():
+            return
+        self.applied = False
+        self.remove_shape()
+
+    def remove_shape(self):
         scene = self.gfx.scene()
         if scene is not None:
             scene.removeItem(self.gfx)
             scene.gfx_removed.emit(self.gfx)
 
+    # Built on demand, only for the rows the history panel shows
+    def text(self):
+        return "Created "+self.shape_name()+" at "+self.shape_coords()
+
     def shape_name(self):
         return self.clss.__name__.replace("Pango", "").replace("Graphic", "")
 
@@ -244,42 +362,113 @@ class CreateShape(QUndoCommand):
         return "("+str(round(self.pos.x()))\
               +", "+str(round(self.pos.y()))+")"
 
+""" ExtendShape adds points to a shape, consecutive lineTo segments of a
+   stroke are merged into one command holding their coordinates """
 class ExtendShape(QUndoCommand):
     def __init__(self, pos, gfx, motion=None):
         super().__init__()
         self.gfx = gfx
         self.pos = pos
         self.motion = motion
-        self.setText("Extended "+self.gfx.name+" to ("
-            +str(round(self.pos.x()))+", "+str(round(self.pos.y()))+")")
+        self.restored = False
+        self.points = array("d", (pos.x(), pos.y()))
+        self.count = None # Path elements before the first redo
+        self.replaced = None
+
+        # Per-point undo within a stroke, when the scene turns merging off
+        self.mergeable = motion == "lineTo" and getattr(gfx.scene(), "merge_strokes", True)
+
+    def text(self):
+        if self.mergeable:
+            return "Extended "+self.gfx.name
+        return "Extended "+self.gfx.name+" to ("\
+            +str(round(self.pos.x()))+", "+str(round(self.pos.y()))+")"
+
+    def id(self):
+        return 1 if self.mergeable else -1
+
+    def mergeWith(self, other):
+        if other.gfx is not self.gfx or not other.mergeable:
+            return False
+        self.points.extend(other.points) # Already drawn by other's redo
+        self.pos = other.pos
+        return True
 
     def redo(self):
+        if self.isObsolete():
+            return
+        self.applied = True
+        if self.restored: # Pushed from a saved history, already applied
+            return
         if self.gfx.scene() is not None:
             self.gfx.scene().active_com = self
-        self.gfx.prepareGeometryChange()
 
+        # Only the new segment is repainted
         if type(self.gfx) is PangoPathGraphic:
-           getattr(self.gfx.path, self.motion)(self.pos)
+            start = self.gfx.path.currentPosition()
+            self.count = self.gfx.path.elementCount()
+            if self.motion == "moveTo" and self.count > 0: # Replaces a trailing moveTo
+                last = self.gfx.path.elementAt(self.count-1)
+                if last.type == QPainterPath.MoveToElement:
+                    self.count -= 1
+                    self.replaced = last.x, last.y
+            extend = getattr(self.gfx.path, self.motion)
+            for i in range(0, len(self.points), 2):
+                extend(self.points[i], self.points[i+1])
+
+            margin = (self.gfx.path.width or 0)/2+1
+            if self.motion == "moveTo":
+                start = self.pos
+            self.gfx.extend_geometry(self.segment_rect(start, margin))
 
         elif type(self.gfx) is PangoPolyGraphic:
+            start = self.gfx.poly.last() if self.gfx.poly.count() > 0 else self.pos
             self.gfx.poly += self.pos
-
-        self.gfx.update()
+            self.update_handles(self.gfx.poly.count()-1)
+
+            if self.gfx.poly.count() > 1 and self.gfx.poly.isClosed(): # Now filled
+                self.gfx.prepareGeometryChange()
+                self.gfx.update()
+            else:
+                scene = self.gfx.scene()
+                margin = scene.context.dw*2+scene.context.pen_width if scene is not None else 0
+                self.gfx.extend_geometry(self.segment_rect(start, margin))
+
+    def segment_rect(self, start, margin):
+        xs = self.points[0::2]
+        ys = self.points[1::2]
+        left, right = min(start.x(), min(xs)), max(start.x(), max(xs))
+        top, bottom = min(start.y(), min(ys)), max(start.y(), max(ys))
+        return QRectF(left-margin, top-margin, right-left+2*margin, bottom-top+2*margin)
 
     def undo(self):
+        if self.isObsolete():
+            return
+        self.applied = False
         if self.gfx.scene() is not None:
             self.gfx.scene().active_com = self
         self.gfx.prepareGeometryChange()
 
         if type(self.gfx) is PangoPathGraphic:
-            ele = self.gfx.path.elementAt(self.gfx.path.elementCount())
-            del ele
+            if self.count is None: # Restored, the path ends with this command
+                self.count = self.gfx.path.elementCount()-len(self.points)//2
+            self.gfx.path.truncate(self.count)
+            if self.replaced is not None:
+                self.gfx.path.moveTo(*self.replaced)
 
         elif type(self.gfx) is PangoPolyGraphic:
             self.gfx.poly.remove(self.gfx.poly.count()-1)
+            self.update_handles(self.gfx.poly.count())
 
         self.gfx.update()
 
+    def update_handles(self, *keys):
+        if self.gfx.scene() is not None:
+            self.gfx.scene().handles.update(self.gfx, keys)
+
+""" MoveShape moves one polygon vertex or bbox corner. While dragging, the
+   geometry follows the mouse through drag and the command is pushed once,
+   on release """
 class MoveShape(QUndoCommand):
     def __init__(self, pos, gfx, idx=None, corner=None):
         super().__init__()
@@ -287,49 +476,63 @@ class MoveShape(QUndoCommand):
         self.pos = pos
         self.idx = idx
         self.corner = corner
-        self.setText("Moved point in "+self.gfx.name+" to ("
-            +str(round(self.pos.x()))+", "+str(round(self.pos.y()))+")")
+        self.restored = False
+        self.old_pos = self.current_pos()
 
-    def redo(self):
-        if self.gfx.scene() is not None:
-            self.gfx.scene().active_com = self
-        self.gfx.prepareGeometryChange()
+    def text(self):
+        return "Moved point in "+self.gfx.name+" to ("\
+            +str(round(self.pos.x()))+", "+str(round(self.pos.y()))+")"
 
+    def current_pos(self):
         if type(self.gfx) is PangoPolyGraphic:
-            self.old_pos = self.gfx.poly.value(self.idx)
+            return self.gfx.poly.value(self.idx)
+        elif type(self.gfx) is PangoBboxGraphic:
+            return getattr(self.gfx.rect, self.corner)()
 
+    def set_pos(self, pos):
+        self.gfx.prepareGeometryChange()
+
+        if type(self.gfx) is PangoPolyGraphic:
             if self.gfx.poly.isClosed(): # Keep closed
                 if self.idx == 0:
-                    self.gfx.poly.replace(self.gfx.poly.count()-1, self.pos)
+                    self.gfx.poly.replace(self.gfx.poly.count()-1, pos)
                 if self.idx == self.gfx.poly.count()-1:
-                    self.gfx.poly.replace(0, self.pos)
+                    self.gfx.poly.replace(0, pos)
 
-            self.gfx.poly.replace(self.idx, self.pos)
+            self.gfx.poly.replace(self.idx, pos)
+            self.update_handles(0, self.idx, self.gfx.poly.count()-1)
 
         elif type(self.gfx) is PangoBboxGraphic:
-            self.old_pos = getattr(self.gfx.rect, self.corner)()
-            getattr(self.gfx.rect, "set"+self.corner[0].upper()+self.corner[1:])(self.pos)
+            getattr(self.gfx.rect, "set"+self.corner[0].upper()+self.corner[1:])(pos)
+            self.update_handles(*pango_corners) # Neighbouring corners move too
 
         self.gfx.update()
 
-    def undo(self):
+    def update_handles(self, *keys):
         if self.gfx.scene() is not None:
-            self.gfx.scene().active_com = self
-        self.gfx.prepareGeometryChange()
+            self.gfx.scene().handles.update(self.gfx, keys)
 
-        if type(self.gfx) is PangoPolyGraphic:
-            if self.gfx.poly.isClosed():
-                if self.idx == 0:
-                    self.gfx.poly.replace(self.gfx.poly.count()-1, self.old_pos)
-                if self.idx == self.gfx.poly.count()-1:
-                    self.gfx.poly.replace(0, self.old_pos)
-
-            self.gfx.poly.replace(self.idx, self.old_pos)
+    def drag(self, pos):
+        self.pos = pos
+        self.set_pos(pos)
 
-        elif type(self.gfx) is PangoBboxGraphic:
-            getattr(self.gfx.rect, "set"+self.corner[0].upper()+self.corner[1:])(self.old_pos)
+    def redo(self):
+        if self.isObsolete():
+            return
+        self.applied = True
+        if self.restored: # Pushed from a saved history, already applied
+            return
+        if self.gfx.scene() is not None:
+            self.gfx.scene().active_com = self
+        self.set_pos(self.pos)
 
-        self.gfx.update()
+    def undo(self):
+        if self.isObsolete():
+            return
+        self.applied = False
+        if self.gfx.scene() is not None:
+            self.gfx.scene().active_com = self
+        self.set_pos(self.old_pos)
 
 
 class PangoGraphicsView(QGraphicsView):
@@ -339,6 +542,32 @@ class PangoGraphicsView(QGraphicsView):
         self.setMouseTracking(True)
         self.setCacheMode(QGraphicsView.CacheBackground)
 
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(150)
+        self.idle_timer.timeout.connect(self.end_draft)
+
+    # Cheap rendering while input is active, one full repaint once idle
+    def begin_draft(self):
+        if self.scene() is None:
+            return
+        self.scene().draft = True
+        self.idle_timer.start()
+
+    def end_draft(self):
+        if self.scene() is not None and self.scene().draft:
+            self.scene().draft = False
+            self.scene().invalidate(self.scene().sceneRect())
+
+    def scrollContentsBy(self, dx, dy):
+        self.begin_draft()
+        super().scrollContentsBy(dx, dy)
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() != Qt.NoButton:
+            self.begin_draft()
+        super().mouseMoveEvent(event)
+
     def set_cursor(self, tool):
         if tool == "Pan":
             self.setDragMode(QGraphicsView.ScrollHandDrag)
@@ -363,6 +592,7 @@ class PangoGraphicsView(QGraphicsView):
                 self.scene().reset_com()
 
     def wheelEvent(self, event):
+        self.begin_draft()
         self.setTransformationAnchor(QGraphicsView.NoAnchor)
         self.setResizeAnchor(QGraphicsView.NoAnchor)
         zoom = 1.05
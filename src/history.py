@@ -0,0 +1,158 @@
+import struct
+from array import array
+
+from PyQt5.QtCore import QPointF
+
+from .graphics import CreateShape, ExtendShape, MoveShape
+from .item import PangoBboxGraphic, PangoPathGraphic, PangoPolyGraphic
+
+# Records are tuples, starting with their kind
+CREATE, EXTEND, MOVE, BEGIN_MACRO, END_MACRO = range(0, 5)
+
+pango_shape_classes = [PangoPathGraphic, PangoPolyGraphic, PangoBboxGraphic]
+pango_motions = [None, "moveTo", "lineTo"]
+pango_corners = [None, "topLeft", "topRight", "bottomLeft", "bottomRight"]
+
+def pango_command_record(com):
+    if type(com) is CreateShape:
+        return (CREATE, com.gfx, pango_shape_classes.index(com.clss), com.p_gfx,
+                com.pos.x(), com.pos.y())
+    elif type(com) is ExtendShape:
+        return (EXTEND, com.gfx, pango_motions.index(com.motion), com.points)
+    elif type(com) is MoveShape:
+        return (MOVE, com.gfx, -1 if com.idx is None else com.idx, pango_corners.index(com.corner),
+                com.pos.x(), com.pos.y(), com.old_pos.x(), com.old_pos.y())
+    return None
+
+# Applied commands only, the redo tail is left out
+def pango_history_records(stack):
+    records = []
+    for i in range(0, stack.index()):
+        com = stack.command(i)
+        if com.isObsolete():
+            continue
+        if com.childCount() > 0:
+            children = [pango_command_record(com.child(j)) for j in range(0, com.childCount())]
+            records.append((BEGIN_MACRO, com.text()))
+            records.extend(r for r in children if r is not None)
+            records.append((END_MACRO,))
+        else:
+            record = pango_command_record(com)
+            if record is not None:
+                records.append(record)
+    return records
+
+# Shapes and labels the records refer to
+def pango_record_shapes(records):
+    gfxs = []
+    for r in records:
+        if r[0] in (BEGIN_MACRO, END_MACRO):
+            continue
+        gfxs.append(r[1])
+        if r[0] == CREATE:
+            gfxs.append(r[3])
+    return gfxs
+
+# Shapes are written as ids, records of shapes without one are dropped
+def pango_pack_history(records, ids):
+    out = bytearray()
+    macro = None
+    for r in records:
+        if r[0] == BEGIN_MACRO:
+            text = r[1].encode()
+            macro = len(out)
+            out += struct.pack("<BH", BEGIN_MACRO, len(text))+text
+            continue
+        elif r[0] == END_MACRO:
+            if macro is not None and len(out) == macro+3+struct.unpack_from("<H", out, macro+1)[0]:
+                del out[macro:] # Empty
+            else:
+                out += struct.pack("<B", END_MACRO)
+            macro = None
+            continue
+
+        if r[1] not in ids or (r[0] == CREATE and r[3] not in ids):
+            continue
+        out += struct.pack("<BI", r[0], ids[r[1]])
+        if r[0] == CREATE:
+            out += struct.pack("<BI2f", r[2], ids[r[3]], r[4], r[5])
+        elif r[0] == EXTEND:
+            out += struct.pack("<BI", r[2], len(r[3])//2)+array("f", r[3]).tobytes()
+        elif r[0] == MOVE:
+            out += struct.pack("<iB4f", *r[2:])
+    return bytes(out)
+
+def pango_unpack_history(data, gfxs):
+    def gfx(i):
+        return gfxs[i] if i < len(gfxs) else None
+
+    records = []
+    pos = 0
+    while pos < len(data):
+        kind = data[pos]
+        if kind == BEGIN_MACRO:
+            n, = struct.unpack_from("<H", data, pos+1)
+            records.append((BEGIN_MACRO, data[pos+3:pos+3+n].decode()))
+            pos += 3+n
+            continue
+        elif kind == END_MACRO:
+            records.append((END_MACRO,))
+            pos += 1
+            continue
+
+        _, i = struct.unpack_from("<BI", data, pos)
+        pos += 5
+        if kind == CREATE:
+            c, label, x, y = struct.unpack_from("<BI2f", data, pos)
+            records.append((CREATE, gfx(i), c, gfx(label), x, y))
+            pos += struct.calcsize("<BI2f")
+        elif kind == EXTEND:
+            motion, n = struct.unpack_from("<BI", data, pos)
+            pos += 5
+            points = array("d", array("f", data[pos:pos+n*8]))
+            records.append((EXTEND, gfx(i), motion, points))
+            pos += n*8
+        elif kind == MOVE:
+            records.append((MOVE, gfx(i))+struct.unpack_from("<iB4f", data, pos))
+            pos += struct.calcsize("<iB4f")
+        else:
+            raise ValueError("Unknown history record: "+str(kind))
+    return records
+
+# Commands are pushed without being redone, shapes already hold the result.
+# Records of shapes without a graphic are skipped, a macro is only opened
+# once one of its records is restored
+def pango_restore_history(scene, records, fpath):
+    macro = None
+    opened = False
+    for r in records:
+        if r[0] == BEGIN_MACRO:
+            macro, opened = r[1], False
+            continue
+        elif r[0] == END_MACRO:
+            if opened:
+                scene.stack.endMacro()
+            macro, opened = None, False
+            continue
+        elif r[1] is None:
+            continue
+
+        if r[0] == CREATE:
+            if r[3] is None:
+                continue
+            com = CreateShape(pango_shape_classes[r[2]], QPointF(r[4], r[5]), r[3], r[1])
+            com.fpath = fpath
+        elif r[0] == EXTEND:
+            points = r[3]
+            com = ExtendShape(QPointF(points[-2], points[-1]), r[1], pango_motions[r[2]])
+            com.points = points
+        elif r[0] == MOVE:
+            com = MoveShape(QPointF(r[4], r[5]), r[1], None if r[2] < 0 else r[2], pango_corners[r[3]])
+            com.old_pos = QPointF(r[6], r[7])
+
+        if macro is not None and not opened:
+            scene.stack.beginMacro(macro)
+            opened = True
+        com.restored = True
+        scene.push(com)
+        com.restored = False
@@ -0,0 +1,253 @@
+import json, math, os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QRect, QRectF, QSize, Qt
+from PyQt5.QtGui import QImage, QImageReader, QPainter, QPixmap
+from PyQt5.QtWidgets import QStyleOptionGraphicsItem
+
+from .utils import pango_cache_dir, pango_file_key
+
+
+class PangoLRUCache(object):
+    def __init__(self, capacity, cost=None):
+        self.capacity = capacity
+        self.cost = cost if cost is not None else lambda v: 1
+        self.total = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.pop(key)
+        self.entries[key] = value
+        self.total += self.cost(value)
+
+        # Evict least recently used, but always keep the newest entry
+        while self.total > self.capacity and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.total -= self.cost(old)
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.total -= self.cost(value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.total = 0
+
+""" PangoImageSource splits a full resolution image into a pyramid of fixed
+   size tiles, level n being downsampled by 2^n """
+class PangoImageSource(object):
+    tile_size = 512
+
+    def __init__(self, size):
+        self._size = QSize(size)
+
+    def size(self):
+        return QSize(self._size)
+
+    def rect(self):
+        return QRectF(0, 0, self._size.width(), self._size.height())
+
+    def level_count(self):
+        n, s = 1, max(self._size.width(), self._size.height())
+        while s > self.tile_size:
+            s = math.ceil(s/2)
+            n += 1
+        return n
+
+    def level_size(self, level):
+        f = 2**level
+        return QSize(math.ceil(self._size.width()/f), math.ceil(self._size.height()/f))
+
+    def tile_count(self, level):
+        s = self.level_size(level)
+        return math.ceil(s.width()/self.tile_size), math.ceil(s.height()/self.tile_size)
+
+    def tile_rect(self, level, col, row):
+        ts = self.tile_size
+        s = self.level_size(level)
+        return QRect(col*ts, row*ts, ts, ts).intersected(QRect(0, 0, s.width(), s.height()))
+
+    # Level n tile made from the (up to) four level n-1 tiles it covers
+    def compose_tile(self, level, col, row, child=None):
+        child = child if child is not None else self.tile
+        ts = self.tile_size
+        lower = self.level_size(level-1)
+        w = min(2*ts, lower.width()-2*col*ts)
+        h = min(2*ts, lower.height()-2*row*ts)
+
+        canvas = QImage(QSize(w, h), QImage.Format_ARGB32_Premultiplied)
+        canvas.fill(Qt.transparent)
+        painter = QPainter(canvas)
+        for dr in (0, 1):
+            for dc in (0, 1):
+                if dc*ts < w and dr*ts < h:
+                    painter.drawImage(dc*ts, dr*ts, child(level-1, 2*col+dc, 2*row+dr))
+        painter.end()
+
+        return canvas.scaled(self.tile_rect(level, col, row).size(),
+                Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+    def tile(self, level, col, row):
+        return self.compose_tile(level, col, row)
+
+""" PangoQImageSource serves tiles of a decoded image. Downsampled levels
+   are kept within a budget, and rebuilt from the image when evicted """
+class PangoQImageSource(PangoImageSource):
+    level_capacity = 64*2**20
+
+    def __init__(self, image):
+        super().__init__(image.size())
+        self.image = image
+        self.levels = PangoLRUCache(self.level_capacity, lambda img: img.sizeInBytes())
+
+    def level_image(self, level):
+        if level == 0:
+            return self.image
+        img = self.levels.get(level)
+        if img is None:
+            img = self.level_image(level-1).scaled(
+                    self.level_size(level), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.levels.put(level, img)
+        return img
+
+    def tile(self, level, col, row):
+        return self.level_image(level).copy(self.tile_rect(level, col, row))
+
+class PangoPyramidSource(PangoImageSource):
+    def __init__(self, folder, size, tile_size, ext, base_ext=None):
+        super().__init__(size)
+        self.folder = folder
+        self.tile_size = tile_size
+        self.ext = ext
+        self.base_ext = base_ext or ext # Full resolution tiles
+
+    def tile_path(self, level, col, row):
+        ext = self.base_ext if level == 0 else self.ext
+        return os.path.join(self.folder, "%d_%d_%d%s" % (level, col, row, ext))
+
+    def tile(self, level, col, row):
+        return QImage(self.tile_path(level, col, row))
+
+def pango_pyramid_dir(fpath):
+    return os.path.join(pango_cache_dir(fpath, "pyramids"), pango_file_key(fpath))
+
+def pango_pyramid_source(fpath):
+    try:
+        folder = pango_pyramid_dir(fpath)
+        with open(os.path.join(folder, "manifest.json")) as f:
+            m = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return PangoPyramidSource(folder, QSize(m["width"], m["height"]), m["tile_size"], m["ext"], m.get("base_ext"))
+
+def pango_read_image(fpath):
+    return QImageReader(fpath).read()
+
+# Scaled decoding, for JPEGs only the needed DCT coefficients are read
+def pango_read_preview(fpath, size):
+    reader = QImageReader(fpath)
+    full = reader.size()
+    if full.isValid() and (full.width() > size.width() or full.height() > size.height()):
+        reader.setScaledSize(full.scaled(size, Qt.KeepAspectRatio))
+    return reader.read()
+
+def pango_source_preview(src, size):
+    top = src.level_count()-1
+    return src.tile(top, 0, 0).scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+""" PangoTiledImage draws only the visible tiles of a source, at the pyramid
+   level matching the painter's transform """
+class PangoTiledImage(object):
+    def __init__(self, capacity=128*2**20):
+        self.source = None
+        self.preview = QImage()
+        self.full_size = QSize()
+        self.visible = True
+        self.tiles = PangoLRUCache(capacity, lambda px: px.width()*px.height()*4)
+
+    def set_source(self, source):
+        self.source = source
+        self.preview = QImage()
+        self.full_size = source.size() if source is not None else QSize()
+        self.tiles.clear()
+
+    # Stretched over the full size until a source is set
+    def set_preview(self, preview, size):
+        self.source = None
+        self.preview = preview
+        self.full_size = QSize(size)
+        self.tiles.clear()
+
+    def size(self):
+        return QSize(self.full_size)
+
+    def rect(self):
+        if not self.full_size.isValid():
+            return QRectF()
+        return QRectF(0, 0, self.full_size.width(), self.full_size.height())
+
+    def level_for_scale(self, scale):
+        # Coarsest level which is still at least as detailed as the screen
+        if scale <= 0:
+            return 0
+        level = math.floor(math.log2(1/scale))
+        return max(0, min(level, self.source.level_count()-1))
+
+    def tile_pixmap(self, level, col, row):
+        key = (level, col, row)
+        px = self.tiles.get(key)
+        if px is None:
+            px = QPixmap.fromImage(self.source.tile(level, col, row))
+            self.tiles.put(key, px)
+        return px
+
+    # Drafts use the next coarser level, mostly served from cached tiles
+    def draw(self, painter, rect, draft=False):
+        if not self.visible:
+            return
+        if self.source is None:
+            if not self.preview.isNull():
+                painter.drawImage(self.rect(), self.preview)
+            return
+
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.level_for_scale(scale/2 if draft else scale)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, not draft)
+
+        size = self.source.size()
+        l_size = self.source.level_size(level)
+        sx = size.width()/l_size.width()
+        sy = size.height()/l_size.height()
+
+        exposed = rect.intersected(self.source.rect())
+        if exposed.isEmpty():
+            return
+
+        ts = self.source.tile_size
+        cols, rows = self.source.tile_count(level)
+        c0 = max(0, math.floor(exposed.left()/sx/ts))
+        c1 = min(cols-1, math.floor(exposed.right()/sx/ts))
+        r0 = max(0, math.floor(exposed.top()/sy/ts))
+        r1 = min(rows-1, math.floor(exposed.bottom()/sy/ts))
+
+        for row in range(r0, r1+1):
+            for col in range(c0, c1+1):
+                t = self.source.tile_rect(level, col, row)
+                target = QRectF(t.x()*sx, t.y()*sy, t.width()*sx, t.height()*sy)
+                px = self.tile_pixmap(level, col, row)
+                painter.drawPixmap(target, px, QRectF(px.rect()))
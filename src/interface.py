@@ -1,22 +1,38 @@
 from PyQt5.QtCore import QItemSelectionModel, QModelIndex, QPersistentModelIndex, QRectF, Qt
-from PyQt5.QtGui import QColor, QStandardItemModel
+from PyQt5.QtGui import QColor, QPainterPath, QPolygonF, QStandardItemModel
 from PyQt5.QtWidgets import QGraphicsItem
 
 from bidict import bidict
+from .dock import PangoImageTreeModel
 from .graphics import PangoGraphicsScene
 from .item import PainterPath, PangoLabelGraphic, PangoLabelItem, PangoPathGraphic, PangoPathItem, PangoPolyGraphic, PangoPolyItem, PangoBboxGraphic, PangoBboxItem, PolygonF
 
+# Fields each kind of change can touch, None for all of them. Geometry is
+# shared between an item and its graphic, edits in place need no sync
+pango_role_fields = {Qt.DisplayRole: ["name"], Qt.EditRole: ["name"],
+        Qt.CheckStateRole: ["visible"], Qt.DecorationRole: ["color"]}
+pango_change_fields = {QGraphicsItem.ItemToolTipHasChanged: ["name"],
+        QGraphicsItem.ItemSceneHasChanged: None, QGraphicsItem.ItemParentHasChanged: None}
+pango_geometry_fields = ["width", "path", "poly", "rect"]
+
 """ PangoModelSceneInterface promotes loose coupling by keeping model/view and 
    scene/view from referring to each other explicitly """
 class PangoModelSceneInterface(object):
     def __init__(self):
         super().__init__()
         self.map = bidict()
+        self.syncing = None # Item or graphic being written to, its echoes are ignored
+        self.fpaths = {} # Image path to the keys of its shapes, in creation order
+        self.key_fpaths = {}
+        self.hydrated = set() # Image paths whose shapes have graphics
+        self.dry = {} # Image path to keys of shapes still without one
 
         # Model/View changes (item) ----> Scene/View (gfx)
         self.model = QStandardItemModel()
         self.model.dataChanged.connect(self.item_changed)
         self.model.rowsAboutToBeRemoved.connect(self.item_removed)
+        self.tree_model = PangoImageTreeModel()
+        self.tree_model.setSourceModel(self.model)
 
         # Scene/View changes (gfx) ----> Model/View (item)
         self.scene = PangoGraphicsScene()
@@ -29,20 +45,85 @@ class PangoModelSceneInterface(object):
         if self.tree.selectionModel() is not None:
             self.tree.selectionModel().selectionChanged.connect(self.item_selection_changed)
 
+    def index_shape(self, key, fpath):
+        old = self.key_fpaths.get(key)
+        if old == fpath:
+            return
+        if old is not None:
+            self.fpaths[old].pop(key, None)
+            if not self.fpaths[old]:
+                del self.fpaths[old]
+            del self.key_fpaths[key]
+        if fpath is not None:
+            self.fpaths.setdefault(fpath, {})[key] = None
+            self.key_fpaths[key] = fpath
+
+        if old == self.tree_model.fpath:
+            self.tree_model.hide(key)
+        elif fpath is not None and fpath == self.tree_model.fpath:
+            self.tree_model.show(key)
+
+    def clear_index(self):
+        self.fpaths.clear()
+        self.key_fpaths.clear()
+        self.hydrated.clear()
+        self.dry.clear()
+
+    # Graphics of shapes are only created once their image is needed
+    def hydrate(self, fpath):
+        if fpath in self.hydrated:
+            return
+        self.hydrated.add(fpath)
+        for key in self.dry.pop(fpath, ()):
+            if key.isValid() and key not in self.map:
+                self.model.itemFromIndex(QModelIndex(key)).force_update()
+
+    def items_for(self, fpath):
+        items = []
+        for key in list(self.fpaths.get(fpath, ())):
+            if not key.isValid(): # Removed along with its label
+                self.index_shape(key, None)
+                continue
+            items.append(self.model.itemFromIndex(QModelIndex(key)))
+        return items
+
+    # Only shapes of the outgoing and incoming images are touched, unless
+    # there is no outgoing one. Shapes of recent images are parked, hidden,
+    # instead of being removed, up to the scene's park_limit. The tree only
+    # lists shapes of the new image
     def filter_tree(self, new_fpath, old_fpath):
-        for key, gfx in self.map.items():
+        self.hydrate(new_fpath)
+        evicted = self.scene.park(new_fpath, old_fpath)
+        if old_fpath is None:
+            keys = [child.key() for row in range(0, self.model.rowCount())
+                for child in self.model.item(row).children()]
+        else:
+            keys = [item.key() for fpath in [old_fpath, new_fpath]+evicted
+                for item in self.items_for(fpath)]
+
+        shown = []
+        for key in keys:
+            gfx = self.map.get(key)
             item = self.model.itemFromIndex(QModelIndex(key))
             if hasattr(item, "fpath"): # ( = not a label)
                 if item.fpath == new_fpath:
-                    self.tree.setRowHidden(item.row(), item.parent().index(), False)
+                    shown.append(key)
                     if gfx.scene() is None:
                         self.scene.addItem(gfx)
                         gfx.setParentItem(self.map[item.parent().key()])
                         gfx.inherit_color() # incase color has changed
+                    elif gfx.parked:
+                        gfx.park(False)
+                        gfx.inherit_color()
                 else:
-                    self.tree.setRowHidden(item.row(), item.parent().index(), True)
-                    if gfx.scene() is not None:
+                    if gfx is None or gfx.scene() is None:
+                        continue
+                    if item.fpath in self.scene.parked:
+                        gfx.park(True)
+                    else:
                         self.scene.removeItem(gfx)
+                        gfx.park(False)
+        self.tree_model.set_shapes(new_fpath, shown)
 
     def switch_label(self, row):
         item = self.model.item(row)
@@ -60,17 +141,18 @@ class PangoModelSceneInterface(object):
             gfxs = []
             item = self.model.item(row)
             for i in range(0, item.rowCount()):
-                gfxs.append(self.map[item.child(i).key()])
+                if item.child(i).key() in self.map:
+                    gfxs.append(self.map[item.child(i).key()])
 
             self.scene.unravel_shapes(*gfxs)
             idx = item.index()
             self.model.removeRow(idx.row(), idx.parent())
-            self.model.removeRow(idx.row(), idx.parent()) # Twice is necessary
             self.filter_tree(self.scene.fpath, None)
 
     def item_selection_changed(self):
         try:
-            new = [self.map[QPersistentModelIndex(idx)] for idx in self.tree.selectedIndexes()]
+            new = [self.map[QPersistentModelIndex(self.tree_model.mapToSource(idx))]
+                for idx in self.tree.selectedIndexes()]
         except KeyError:
             return
         old = self.scene.selectedItems()
@@ -83,7 +165,8 @@ class PangoModelSceneInterface(object):
 
     def gfx_selection_changed(self):
         try:
-            new = [QModelIndex(self.map.inverse[gfx]) for gfx in self.scene.selectedItems()]
+            new = [self.tree_model.mapFromSource(QModelIndex(self.map.inverse[gfx]))
+                for gfx in self.scene.selectedItems()]
         except KeyError:
             return
         old = self.tree.selectedIndexes()
@@ -98,40 +181,96 @@ class PangoModelSceneInterface(object):
         if roles is None:
             return
         item = self.model.itemFromIndex(top_idx)
+        if item is self.syncing:
+            return
         #print("Item change: ", pango_item_role_debug(roles[0]))
 
+        fields = set() if roles else None
+        for role in roles:
+            if pango_role_fields.get(role, None) is None:
+                fields = None
+                break
+            fields.update(pango_role_fields[role])
+
         try:
             gfx = self.map[item.key()]
         except KeyError:
+            if hasattr(item, "fpath") and item.fpath not in self.hydrated:
+                self.dry.setdefault(item.fpath, {})[item.key()] = None
+                self.index_shape(item.key(), item.fpath)
+                return
             gfx = self.create_gfx_from_item(item)
+            fields = None
 
-        # Sync properties 
-        for k, v in item.getattrs().items():
-            if not self.var_empty(v):
-                setattr(gfx, k, v)
+        # Sync changed properties
+        changed = geometry = False
+        self.syncing = gfx
+        for k, v in self.changed_attrs(item, fields).items():
+            old = getattr(gfx, k)
+            if old is v or self.var_empty(v) or (k not in pango_geometry_fields and old == v):
+                continue
+            if k in pango_geometry_fields and not geometry:
+                gfx.prepareGeometryChange()
+                geometry = True
+            setattr(gfx, k, v)
+            changed = True
+        self.syncing = None
 
+        if changed:
+            gfx.update()
+        if geometry:
+            self.scene.handles.invalidate(gfx)
+        if hasattr(item, "fpath") and (fields is None or "fpath" in fields):
+            self.index_shape(item.key(), item.fpath)
 
     def gfx_changed(self, gfx, change):
+        if gfx is self.syncing:
+            return
+        fields = pango_change_fields.get(change, [])
+        if fields == []:
+            return
         #print("Gfx change: ", pango_gfx_change_debug(change))
+
         try:
             item = self.model.itemFromIndex(QModelIndex(self.map.inverse[gfx]))
         except KeyError:
+            if fields is not None:
+                return
             item = self.create_item_from_gfx(gfx)
             item.set_icon()
 
-        # Sync properties 
-        for k, v in gfx.getattrs().items():
+        # Sync changed properties, geometry is handed over as is
+        self.syncing = item
+        for k, v in self.changed_attrs(gfx, fields).items():
             if k == "visible" or k == "color":
                 continue # Glitch fix
-            if not self.var_empty(v):
+            old = getattr(item, k)
+            if old is v:
+                continue
+            if k in pango_geometry_fields or (not self.var_empty(v) and old != v):
                 setattr(item, k, v)
+        self.syncing = None
+
+        if hasattr(item, "fpath") and (fields is None or "fpath" in fields):
+            self.index_shape(item.key(), item.fpath)
+
+    def changed_attrs(self, obj, fields):
+        if fields is None:
+            return obj.getattrs()
+        return {k: getattr(obj, k) for k in fields if hasattr(obj, k)}
 
     def var_empty(self, v):
-        return v is None or v==[] or v=="" or v==0\
-                or (type(v) is QColor and v==QColor())\
-                or (type(v) is PainterPath and v==PainterPath())\
-                or (type(v) is PolygonF and v==PolygonF())\
-                or (type(v) is QRectF and v==QRectF())
+        if isinstance(v, QPainterPath):
+            return v.elementCount() == 0
+        elif isinstance(v, QPolygonF):
+            return v.isEmpty()
+        elif isinstance(v, QRectF):
+            return v.isNull() and v.topLeft().isNull()
+        elif isinstance(v, QColor):
+            return not v.isValid()
+        elif isinstance(v, bool):
+            return False
+        return v is None or v==[] or v=="" or v==0
 
     def item_removed(self, parent_idx, first, last):
         if parent_idx.isValid():
@@ -139,9 +278,9 @@ class PangoModelSceneInterface(object):
         else:
             item = self.model.item(first, 0)
 
-        gfx = self.map[item.key()]
-        _ = self.map.pop(item.key())
-        if gfx.scene() is not None:
+        gfx = self.map.pop(item.key(), None)
+        self.index_shape(item.key(), None)
+        if gfx is not None and gfx.scene() is not None:
             gfx.scene().removeItem(gfx)
         del gfx
 
@@ -158,7 +297,7 @@ class PangoModelSceneInterface(object):
             parent_item = self.model.itemFromIndex(
                     QModelIndex(self.map.inverse[gfx.parentItem()]))
             parent_item.appendRow(item)
-            self.tree.expand(parent_item.index())
+            self.tree.expand(self.tree_model.mapFromSource(parent_item.index()))
         else:
             self.model.appendRow(item)
         self.map[item.key()] = gfx
@@ -168,12 +307,15 @@ class PangoModelSceneInterface(object):
         class_name = type(item).__name__.replace("Item", "Graphic")
         gfx = globals()[class_name]()
 
-        # Map, then add to scene
+        # Map, then add to scene if its image is shown. The item's properties
+        # are synced after, not the blank graphic's
         self.map[item.key()] = gfx
-        if item.parent() is not None:
+        self.syncing = gfx
+        if item.parent() is None:
+            self.scene.addItem(gfx)
+        elif getattr(item, "fpath", None) == self.scene.fpath:
             gfx.setParentItem(self.map[item.parent().key()])
             gfx.inherit_color()
-        else:
-            self.scene.addItem(gfx)
+        self.syncing = None
         return gfx
     
@@ -1,6 +1,8 @@
-from PyQt5.QtCore import QPointF, Qt, QRectF, QPersistentModelIndex
-from PyQt5.QtGui import QBrush, QColor, QFont, QFontMetrics, QPainter, QPainterPath, QPainterPathStroker, QPen, QPolygonF, QStandardItem
-from PyQt5.QtWidgets import QAbstractGraphicsShapeItem, QGraphicsItem, QStyle
+import math
+
+from PyQt5.QtCore import QPointF, Qt, QRectF, QPersistentModelIndex, QSize
+from PyQt5.QtGui import QBrush, QColor, QFont, QFontMetrics, QPainter, QPainterPath, QPainterPathStroker, QPen, QPixmap, QPolygonF, QRegion, QStandardItem, QTransform
+from PyQt5.QtWidgets import QAbstractGraphicsShapeItem, QGraphicsItem, QStyle, QStyleOptionGraphicsItem
 
 from .utils import pango_get_icon
 
@@ -100,12 +102,45 @@ class PangoBboxItem(PangoItem):
         self.fpath = None
         self.rect = QRectF()
 
+""" PangoRenderContext holds the metrics shared by all graphics of a scene,
+   recomputed only when the scene's image changes """
+class PangoRenderContext(object):
+    def __init__(self):
+        self.set_size(QSize())
+
+    def set_size(self, size):
+        self.size = QSize(size)
+        dw = getattr(self, "dw", None)
+        if size.isValid() and not size.isEmpty():
+            self.dw = (size.height()+size.width())/400
+        else:
+            self.dw = 10
+        self.pen_width = int(self.dw)
+        if self.dw != dw: # Outdates cached geometry
+            self.generation = getattr(self, "generation", -1)+1
+
+        self.font = QFont()
+        self.font.setPointSizeF(self.dw*3)
+        self.font_metrics = QFontMetrics(self.font)
+
 class PangoGraphic(QAbstractGraphicsShapeItem):
+    # Levels of detail (device pixels per scene unit) below which handles
+    # and captions are left out, and outlines are drawn one pixel wide
+    lod_handles = 0.3
+    lod_text = 0.3
+    lod_outline = 0.1
+    parked = False
+    parking = False
+    shown = True
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
         self.setAcceptHoverEvents(True)
         self.force_opaque = False
+        self.hovered = False
+        self.geometry = None
+        self.loose = False
 
         pen = QPen()
         pen.setCapStyle(Qt.RoundCap)
@@ -139,18 +174,31 @@ class PangoGraphic(QAbstractGraphicsShapeItem):
 
     @property
     def visible(self):
-        return self.isVisible()
+        return self.shown if self.parked else self.isVisible()
 
     @visible.setter
     def visible(self, visible):
-        self.setVisible(visible)
+        if self.parked:
+            self.shown = visible
+        else:
+            self.setVisible(visible)
+
+    # Parked shapes stay in the scene, hidden, while their image is not shown
+    def park(self, parked):
+        if parked == self.parked:
+            return
+        self.parking = True
+        if parked:
+            self.shown = self.isVisibleTo(self.parentItem())
+            self.parked = True
+            self.setVisible(False)
+        else:
+            self.parked = False
+            self.setVisible(self.shown)
+        self.parking = False
 
     def dw(self):
-        rect = QRectF(self.scene().px.rect())
-        if rect != QRectF():
-            return (rect.size().height()+rect.size().width())/400
-        else:
-            return 10
+        return self.scene().context.dw
     
     def inherit_color(self):
         if hasattr(self.parentItem(), "color"):
@@ -163,12 +211,123 @@ class PangoGraphic(QAbstractGraphicsShapeItem):
 
     def itemChange(self, change, value):
         super().itemChange(change, value)
-        if self.scene() is not None:
+        if change == QGraphicsItem.ItemSceneChange and hasattr(self.scene(), "handles"):
+            self.scene().handles.remove(self)
+        elif change == QGraphicsItem.ItemSceneHasChanged and hasattr(self.scene(), "handles"):
+            self.scene().handles.invalidate(self)
+        if change in (QGraphicsItem.ItemSelectedHasChanged, QGraphicsItem.ItemVisibleHasChanged,
+                QGraphicsItem.ItemParentHasChanged, QGraphicsItem.ItemSceneHasChanged):
+            self.layer_changed()
+        if self.scene() is not None and not self.parking:
             self.scene().gfx_changed.emit(self, change)
         return value
 
+    def hoverEnterEvent(self, event):
+        self.hovered = True
+        self.layer_changed()
+        super().hoverEnterEvent(event)
+
+    def hoverLeaveEvent(self, event):
+        self.hovered = False
+        self.layer_changed()
+        super().hoverLeaveEvent(event)
+
+    def layer(self):
+        p_gfx = self.parentItem()
+        if isinstance(p_gfx, PangoLabelGraphic) and p_gfx.composited():
+            return p_gfx
+        return None
+
+    # Shapes being edited are drawn on their own, the rest by their label's layer
+    def layer_changed(self):
+        layer = self.layer()
+        alone = layer is None or self.isSelected() or self.hovered
+        if bool(self.flags() & QGraphicsItem.ItemHasNoContents) == alone:
+            self.setFlag(QGraphicsItem.ItemHasNoContents, not alone)
+        cache = QGraphicsItem.NoCache if layer is not None else QGraphicsItem.DeviceCoordinateCache
+        if self.cacheMode() != cache:
+            self.setCacheMode(cache)
+        if layer is not None:
+            layer.invalidate_layer(self.mapRectToParent(self.boundingRect()))
+
+    def prepareGeometryChange(self):
+        layer = self.layer()
+        if layer is not None:
+            layer.invalidate_layer(self.mapRectToParent(self.boundingRect()))
+        super().prepareGeometryChange()
+        self.invalidate_geometry()
+
+    def setPen(self, pen):
+        if self.geometry is not None and pen.widthF() != self.pen().widthF():
+            self.prepareGeometryChange()
+        super().setPen(pen)
+
+    # Shape and bounding rect are kept until the geometry, pen or dw changes
+    def invalidate_geometry(self):
+        self.geometry = None
+        self.loose = False
+
+    def cached_geometry(self):
+        generation = self.scene().context.generation
+        if self.geometry is None or self.geometry[0] != generation:
+            shape = self.build_shape()
+            self.geometry = (generation, shape, self.build_rect(shape))
+            self.loose = False
+        elif self.geometry[1] is None: # Extended, the rect is still loose
+            self.geometry = (generation, self.build_shape(), self.geometry[2])
+        return self.geometry
+
+    # While a stroke is drawn, the bounding rect grows with slack so the
+    # scene index is only updated when a segment leaves it, and only the
+    # segment is repainted. The shape is rebuilt when next hit-tested
+    def extend_geometry(self, rect):
+        if self.geometry is None or self.scene() is None:
+            self.prepareGeometryChange()
+            self.update()
+            return
+
+        generation, _, bounds = self.geometry
+        if not bounds.contains(rect):
+            self.prepareGeometryChange()
+            bounds = bounds.united(rect)
+            slack = max(bounds.width(), bounds.height())/2
+            bounds.adjust(-slack, -slack, slack, slack)
+        self.geometry = (generation, None, bounds)
+        self.loose = True
+        self.update(rect)
+
+    # Tightens the bounding rect once the stroke ends
+    def settle_geometry(self):
+        if self.loose:
+            self.prepareGeometryChange()
+
+    def shape(self):
+        return self.cached_geometry()[1]
+
+    def boundingRect(self):
+        if self.loose and self.geometry[0] == self.scene().context.generation:
+            return self.geometry[2] # Without rebuilding the shape
+        return self.cached_geometry()[2]
+
+    def build_shape(self):
+        return QPainterPath()
+
+    def build_rect(self, shape):
+        return shape.controlPointRect()
+
+    def update(self, *args):
+        super().update(*args)
+        layer = self.layer()
+        if layer is not None:
+            rect = args[0] if args and type(args[0]) is QRectF else self.boundingRect()
+            layer.invalidate_layer(self.mapRectToParent(rect))
+
+    def draft(self):
+        return getattr(self.scene(), "draft", False)
+
     def paint(self, painter, option, widget):
-        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        if not self.draft():
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
         if self.force_opaque:
             painter.setOpacity(1)
         elif option.state & QStyle.State_Selected:
@@ -176,6 +335,27 @@ class PangoGraphic(QAbstractGraphicsShapeItem):
         else:
             painter.setOpacity(0.5)
 
+    def lod(self, painter):
+        return QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+
+    def lod_pen(self, lod):
+        pen = self.pen()
+        if lod < self.lod_outline:
+            pen.setWidth(0) # Cosmetic
+        else:
+            pen.setWidth(self.scene().context.pen_width)
+        return pen
+
+    # Shapes smaller than a pixel are drawn as one
+    def draw_as_point(self, painter, lod, rect):
+        if max(rect.width(), rect.height())*lod >= 1:
+            return False
+        pen = self.pen()
+        pen.setWidth(0)
+        painter.setPen(pen)
+        painter.drawPoint(rect.center())
+        return True
+
     def shape_from_path(self, path, pen):
         if path == QPainterPath() or pen == Qt.NoPen:
             return path
@@ -205,10 +385,95 @@ class PangoGraphic(QAbstractGraphicsShapeItem):
         del state['_PangoGraphic__parent']
         self.setattrs(**state)
 
+""" In composited mode, a label draws all of its shapes into one overlay
+   layer at view resolution, and redraws only the dirty region of it when
+   a shape changes """
 class PangoLabelGraphic(PangoGraphic):
+    overlay_margin = 256 # Device pixels drawn past the exposed area
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setFlag(QGraphicsItem.ItemClipsChildrenToShape)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.overlay = None
+        self.overlay_rect = QRectF()
+        self.overlay_key = None
+        self.dirty = QRegion()
+
+    def composited(self):
+        return getattr(self.scene(), "composite_labels", False)
+
+    def set_mode(self):
+        on = self.composited()
+        self.setCacheMode(QGraphicsItem.NoCache if on else QGraphicsItem.DeviceCoordinateCache)
+        self.setFlag(QGraphicsItem.ItemClipsChildrenToShape, not on)
+        self.overlay = None
+        for gfx in self.childItems():
+            gfx.layer_changed()
+        self.update()
+
+    def itemChange(self, change, value):
+        if change in (QGraphicsItem.ItemChildAddedChange, QGraphicsItem.ItemChildRemovedChange):
+            if self.overlay is not None and value.scene() is not None:
+                self.invalidate_layer(value.mapRectToParent(value.boundingRect()))
+        value = super().itemChange(change, value)
+        if change == QGraphicsItem.ItemSceneHasChanged and self.scene() is not None:
+            self.set_mode()
+        return value
+
+    def layer_changed(self):
+        pass
+
+    def overlay_transform(self):
+        s = self.overlay_key[0]
+        return QTransform.fromScale(s, s).translate(-self.overlay_rect.x(), -self.overlay_rect.y())
+
+    def invalidate_layer(self, rect=None):
+        if self.overlay is None:
+            return
+        if rect is None:
+            self.overlay = None
+            rect = self.boundingRect()
+        else:
+            self.dirty += self.overlay_transform().mapRect(rect).toAlignedRect().adjusted(-1, -1, 1, 1)
+        QGraphicsItem.update(self, rect)
+
+    def build_overlay(self, exposed, key):
+        # Margin around the exposed area, so panning reuses the overlay
+        m = min(max(exposed.width(), exposed.height())/2, self.overlay_margin/key[0])
+        rect = exposed.adjusted(-m, -m, m, m).intersected(self.boundingRect())
+        w, h = math.ceil(rect.width()*key[0]), math.ceil(rect.height()*key[0])
+
+        self.overlay = QPixmap(max(1, w), max(1, h))
+        self.overlay_rect = QRectF(rect.x(), rect.y(), w/key[0], h/key[0])
+        self.overlay_key = key
+        self.draw_overlay(QRegion(self.overlay.rect()))
+
+    def draw_overlay(self, region):
+        painter = QPainter(self.overlay)
+        painter.setRenderHint(QPainter.Antialiasing, not self.overlay_key[2])
+        painter.setClipRegion(region)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(region.boundingRect(), Qt.transparent)
+
+        t = self.overlay_transform()
+        area = t.inverted()[0].mapRect(QRectF(region.boundingRect()))
+        option = QStyleOptionGraphicsItem()
+        for gfx in self.layer_items(area):
+            painter.save()
+            painter.setTransform(QTransform.fromTranslate(gfx.x(), gfx.y())*t)
+            option.exposedRect = gfx.mapRectFromParent(area).intersected(gfx.boundingRect())
+            gfx.paint(painter, option, None)
+            painter.restore()
+        painter.end()
+        self.dirty = QRegion()
+
+    # Shapes drawn into the overlay over the area
+    def layer_items(self, area):
+        for gfx in self.childItems():
+            if gfx.isVisible() and gfx.flags() & QGraphicsItem.ItemHasNoContents\
+                    and gfx.mapRectToParent(gfx.boundingRect()).intersects(area):
+                yield gfx
 
     @property
     def color(self):
@@ -226,19 +491,50 @@ class PangoLabelGraphic(PangoGraphic):
         for item in self.childItems():
             item.setPen(pen)
             item.setBrush(brush)
+        self.invalidate_layer()
 
     def paint(self, painter, option, widget):
         super().paint(painter, option, widget)
+        if not self.composited():
+            return
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if painter.hasClipping(): # Renders expose the whole item
+            exposed = exposed.intersected(painter.clipBoundingRect())
+        if exposed.isEmpty() or next(self.layer_items(exposed), None) is None:
+            return
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        key = (scale, self.force_opaque, self.draft())
+        if self.overlay is None or not self.overlay_rect.contains(exposed)\
+                or (key != self.overlay_key and not self.draft()):
+            self.build_overlay(exposed, key)
+        elif not self.dirty.isEmpty():
+            self.draw_overlay(self.dirty)
+
+        # Stretched while drafting, rather than rebuilt on every zoom step
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.setOpacity(1)
+        painter.drawPixmap(self.overlay_rect, self.overlay, QRectF(self.overlay.rect()))
 
     def boundingRect(self):
-        return QRectF(self.scene().px.rect())
+        return self.scene().image.rect()
+
+    def shape(self):
+        path = QPainterPath()
+        path.addRect(self.boundingRect())
+        return path
 
 class PangoPathGraphic(PangoGraphic):
+    chunk_size = 256 # Path elements per chunk
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setFlag(QGraphicsItem.ItemIsSelectable)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
         self.fpath = None
         self.path = PainterPath()
+        self.chunks = []
+        self.chunked = 0
 
     def paint(self, painter, option, widget):
         super().paint(painter, option, widget)
@@ -246,12 +542,41 @@ class PangoPathGraphic(PangoGraphic):
         pen.setWidth(self.path.width)
         painter.setPen(pen)
 
-        painter.drawPath(self.path)
-
-    def boundingRect(self):
-        return self.shape().controlPointRect()
-
-    def shape(self):
+        # Only chunks under the exposed rect, drawn as one path so they blend
+        # as one stroke
+        m = (self.path.width or 0)/2+1
+        exposed = option.exposedRect.adjusted(-m, -m, m, m)
+        path = QPainterPath()
+        for chunk in self.path_chunks():
+            if chunk.controlPointRect().intersects(exposed):
+                path.addPath(chunk)
+        painter.drawPath(path)
+
+    # Chunks follow the path as it is extended, and are rebuilt otherwise
+    def path_chunks(self):
+        count = self.path.elementCount()
+        if count < self.chunked:
+            self.chunks, self.chunked = [], 0
+
+        for i in range(self.chunked, count):
+            ele = self.path.elementAt(i)
+            if not self.chunks or self.chunks[-1].elementCount() >= self.chunk_size:
+                self.chunks.append(QPainterPath())
+                if ele.type != QPainterPath.MoveToElement and i > 0:
+                    prev = self.path.elementAt(i-1)
+                    self.chunks[-1].moveTo(prev.x, prev.y) # Joined to the previous chunk
+            if ele.type == QPainterPath.MoveToElement:
+                self.chunks[-1].moveTo(ele.x, ele.y)
+            else:
+                self.chunks[-1].lineTo(ele.x, ele.y)
+        self.chunked = count
+        return self.chunks
+
+    def invalidate_geometry(self):
+        super().invalidate_geometry()
+        self.chunks, self.chunked = [], 0
+
+    def build_shape(self):
         pen = self.pen()
         pen.setWidth(self.path.width)
         st = QPainterPathStroker(pen)
@@ -266,11 +591,12 @@ class PangoPolyGraphic(PangoGraphic):
 
     def paint(self, painter, option, widget):
         super().paint(painter, option, widget)
+        lod = self.lod(painter)
+        if self.poly.count() > 1 and self.draw_as_point(painter, lod, self.poly.boundingRect()):
+            return
 
         w = self.dw()
-        pen = self.pen()
-        pen.setWidth(int(w))
-        painter.setPen(pen)
+        painter.setPen(self.lod_pen(lod))
         painter.setBrush(self.brush())
 
         # Draw Polygon/Polyline
@@ -281,17 +607,19 @@ class PangoPolyGraphic(PangoGraphic):
                 painter.drawLine(self.poly.value(n), self.poly.value(n+1))
 
         # Draw points
+        if (lod < self.lod_handles or self.draft()) and self.poly.count() > 1:
+            return
         if option.state & QStyle.State_MouseOver or self.isSelected()\
                 or not self.poly.isClosed() or self.poly.count() == 1:
             painter.setOpacity(1)
             for n in range(0, self.poly.count()):
                 painter.drawEllipse(self.poly.value(n), w, w)
 
-    def boundingRect(self):
+    def build_rect(self, shape):
         w = self.dw()
-        return self.shape().controlPointRect().adjusted(-w, -w, w, w)
+        return shape.controlPointRect().adjusted(-w, -w, w, w)
 
-    def shape(self):
+    def build_shape(self):
         path = QPainterPath()
         path.addPolygon(self.poly)
         return self.shape_from_path(path, self.pen())
@@ -305,18 +633,22 @@ class PangoBboxGraphic(PangoGraphic):
 
     def paint(self, painter, option, widget):
         super().paint(painter, option, widget)
+        lod = self.lod(painter)
+        if self.draw_as_point(painter, lod, self.rect):
+            return
+
         w = self.dw()
-        pen = self.pen()
-        pen.setWidth(int(w))
-        painter.setPen(pen)
+        painter.setPen(self.lod_pen(lod))
 
         if not self.force_opaque:
             painter.setOpacity(0.8)
         painter.drawRect(self.rect)
 
-        if self.parentItem() is not None:
+        if self.parentItem() is not None and lod >= self.lod_text and not self.draft():
             self.paint_text_rect(painter)
 
+        if lod < self.lod_handles or self.draft():
+            return
         painter.setOpacity(1)
         if option.state & QStyle.State_MouseOver or self.isSelected():
             painter.drawEllipse(self.rect.topLeft(), w, w)
@@ -327,12 +659,11 @@ class PangoBboxGraphic(PangoGraphic):
     def paint_text_rect(self, painter):
         p = painter.pen()
 
-        font = QFont()
-        font.setPointSizeF(self.dw()*3)
-        painter.setFont(font)
+        context = self.scene().context
+        painter.setFont(context.font)
         painter.setBrush(self.brush())
 
-        fm = QFontMetrics(font)
+        fm = context.font_metrics
         w = fm.width(self.parentItem().name)
         h = fm.height()
         br = self.rect.bottomRight()
@@ -349,11 +680,11 @@ class PangoBboxGraphic(PangoGraphic):
 
         painter.setPen(p)
 
-    def boundingRect(self):
+    def build_rect(self, shape):
         w = self.dw()
-        return self.shape().controlPointRect().adjusted(-w*2, -w*2, w*2, w*2)
+        return shape.controlPointRect().adjusted(-w*2, -w*2, w*2, w*2)
 
-    def shape(self):
+    def build_shape(self):
         path = QPainterPath()
         path.addRect(self.rect)
         return self.shape_from_path(path, self.pen())
@@ -371,6 +702,18 @@ class PainterPath(QPainterPath):
             d[i] = [ele.type, ele.x, ele.y]
         return d
 
+    # Keeps the first count elements
+    def truncate(self, count):
+        elements = [self.elementAt(i) for i in range(0, max(0, count))]
+        elements = [(ele.type, ele.x, ele.y) for ele in elements]
+        path = QPainterPath()
+        for t, x, y in elements:
+            if t == QPainterPath.MoveToElement:
+                path.moveTo(x, y)
+            else:
+                path.lineTo(x, y)
+        self.swap(path)
+
     def __setstate__(self, state):
         self.__init__()
         self.width = state["width"]
@@ -0,0 +1,288 @@
+import math, mmap, os, struct, threading, zlib
+
+from PyQt5.QtCore import QRect, QSize, Qt
+from PyQt5.QtGui import QImage, QPainter
+
+from .image import PangoImageSource, PangoLRUCache, PangoQImageSource, pango_pyramid_source, pango_read_image
+
+# TIFF field type -> (struct format, values per count)
+tiff_types = {1: ("B", 1), 2: ("B", 1), 3: ("H", 1), 4: ("I", 1), 5: ("I", 2),
+              6: ("b", 1), 7: ("B", 1), 8: ("h", 1), 9: ("i", 1), 10: ("i", 2),
+              11: ("f", 1), 12: ("d", 1), 13: ("I", 1), 16: ("Q", 1), 17: ("q", 1), 18: ("Q", 1)}
+
+def pango_qimage_format(spp, alpha=2):
+    if spp == 1:
+        return QImage.Format_Grayscale8
+    elif spp == 3:
+        return QImage.Format_RGB888
+    elif spp == 4:
+        return QImage.Format_RGBA8888_Premultiplied if alpha == 1 else QImage.Format_RGBA8888
+    raise ValueError("Unsupported samples per pixel: "+str(spp))
+
+# Only the requested columns of each row are copied out of the mapping
+def pango_read_rows(mm, row_offset, rect, bpp, fmt):
+    x0, x1 = rect.x()*bpp, (rect.x()+rect.width())*bpp
+    rows = []
+    for y in range(rect.y(), rect.y()+rect.height()):
+        offset = row_offset(y)
+        rows.append(mm[offset+x0:offset+x1])
+    data = b"".join(rows)
+    return QImage(data, rect.width(), rect.height(), rect.width()*bpp, fmt).copy()
+
+""" PangoRasterSource reads an image through a memory mapping, decoding only
+   the requested tiles. Levels missing from the file are composed from the
+   level below and kept in an LRU cache """
+class PangoRasterSource(PangoImageSource):
+    def __init__(self, fpath):
+        super().__init__(QSize()) # Known once the header is parsed
+        self.fpath = fpath
+        self.file = open(fpath, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.native = {}
+        self.cache = PangoLRUCache(64*2**20, lambda img: img.sizeInBytes())
+        self.lock = threading.Lock() # Sources are shared between threads
+
+    def read_region(self, level, rect):
+        raise NotImplementedError
+
+    def tile(self, level, col, row):
+        if level == 0 or level in self.native:
+            return self.read_region(level, self.tile_rect(level, col, row))
+
+        key = (level, col, row)
+        with self.lock:
+            img = self.cache.get(key)
+        if img is None:
+            img = self.compose_tile(level, col, row)
+            with self.lock:
+                self.cache.put(key, img)
+        return img
+
+class PangoTiffPage(object):
+    def __init__(self, tags, tables=b""):
+        def get(tag, default=None):
+            return tags[tag][0] if tag in tags else default
+
+        self.width = get(256)
+        self.height = get(257)
+        self.bits = get(258, 1)
+        self.compression = get(259, 1)
+        self.predictor = get(317, 1)
+        self.photometric = get(262, 1)
+        self.spp = get(277, 1)
+        self.planar = get(284, 1)
+        self.subfile = get(254, 0)
+        self.alpha = get(338, 2)
+        self.tables = tables
+
+        self.tiled = 322 in tags
+        if self.tiled:
+            self.chunk_w, self.chunk_h = get(322), get(323)
+            self.offsets, self.counts = tags[324], tags[325]
+        else:
+            self.chunk_w, self.chunk_h = self.width, min(get(278, self.height), self.height)
+            self.offsets, self.counts = tags[273], tags[279]
+
+        if self.bits != 8 or self.planar != 1:
+            raise ValueError("Unsupported TIFF sample layout")
+        if self.compression not in (1, 7, 8, 32946):
+            raise ValueError("Unsupported TIFF compression: "+str(self.compression))
+        if self.predictor != 1:
+            raise ValueError("Unsupported TIFF predictor: "+str(self.predictor))
+        self.fmt = pango_qimage_format(self.spp, self.alpha)
+
+    def size(self):
+        return QSize(self.width, self.height)
+
+class PangoTiffSource(PangoRasterSource):
+    def __init__(self, fpath):
+        super().__init__(fpath)
+        if self.mm[:2] not in (b"II", b"MM"):
+            raise ValueError("Not a TIFF file")
+        self.endian = "<" if self.mm[:2] == b"II" else ">"
+        version, = struct.unpack_from(self.endian+"H", self.mm, 2)
+        if version not in (42, 43):
+            raise ValueError("Not a TIFF file")
+        self.big = version == 43 # BigTIFF
+
+        offset, = struct.unpack_from(self.endian+("Q" if self.big else "I"), self.mm, 8 if self.big else 4)
+        self.pages = []
+        while offset and len(self.pages) < 64:
+            tags, offset = self.read_ifd(offset)
+            tables = bytes(tags[347]) if 347 in tags else b""
+            try:
+                self.pages.append(PangoTiffPage(tags, tables))
+            except (ValueError, KeyError):
+                if not self.pages:
+                    raise # Only extra pages (labels, macros..) may be skipped
+
+        self._size = self.pages[0].size()
+        self.spp = self.pages[0].spp
+        page = self.pages[0]
+        if page.tiled and page.chunk_w == page.chunk_h:
+            self.tile_size = page.chunk_w
+
+        # Reduced resolution pages which line up with a pyramid level
+        for level in range(1, self.level_count()):
+            s = self.level_size(level)
+            for page in self.pages[1:]:
+                if page.spp == self.pages[0].spp and abs(page.width-s.width()) <= 1\
+                        and abs(page.height-s.height()) <= 1:
+                    self.native[level] = page
+                    break
+
+    def read_ifd(self, offset):
+        mm, e = self.mm, self.endian
+        if self.big:
+            n, = struct.unpack_from(e+"Q", mm, offset)
+            head, entry, count_fmt, inline = 8, 20, "Q", 8
+        else:
+            n, = struct.unpack_from(e+"H", mm, offset)
+            head, entry, count_fmt, inline = 2, 12, "I", 4
+
+        tags = {}
+        for i in range(0, n):
+            pos = offset+head+i*entry
+            tag, typ = struct.unpack_from(e+"HH", mm, pos)
+            count, = struct.unpack_from(e+count_fmt, mm, pos+4)
+            if typ not in tiff_types:
+                continue
+            fmt, mult = tiff_types[typ]
+            fmt = e+str(count*mult)+fmt
+
+            value_pos = pos+4+inline
+            if struct.calcsize(fmt) > inline:
+                value_pos, = struct.unpack_from(e+count_fmt, mm, value_pos)
+            tags[tag] = struct.unpack_from(fmt, mm, value_pos)
+
+        next_offset, = struct.unpack_from(e+count_fmt, mm, offset+head+n*entry)
+        return tags, next_offset
+
+    def page(self, level):
+        return self.pages[0] if level == 0 else self.native[level]
+
+    def read_chunk(self, page, idx):
+        offset, count = page.offsets[idx], page.counts[idx]
+        data = self.mm[offset:offset+count]
+
+        if page.compression == 7: # JPEG, tables are shared between chunks
+            if page.tables:
+                data = page.tables[:-2]+data[2:]
+            return QImage.fromData(data, "JPG")
+        elif page.compression in (8, 32946):
+            data = zlib.decompress(data)
+
+        rows = page.chunk_h
+        if not page.tiled:
+            rows = min(rows, page.height-idx*page.chunk_h)
+        img = QImage(data, page.chunk_w, rows, page.chunk_w*page.spp, page.fmt).copy()
+        if page.photometric == 0: # WhiteIsZero
+            img.invertPixels()
+        return img
+
+    def read_region(self, level, rect):
+        page = self.page(level)
+        rect = rect.intersected(QRect(0, 0, page.width, page.height))
+
+        if page.compression == 1 and not page.tiled:
+            stride = page.width*page.spp
+            rps = page.chunk_h
+            img = pango_read_rows(self.mm,
+                    lambda y: page.offsets[y//rps]+(y % rps)*stride, rect, page.spp, page.fmt)
+            if page.photometric == 0:
+                img.invertPixels()
+            return img
+
+        cw, ch = page.chunk_w, page.chunk_h
+        cols = math.ceil(page.width/cw)
+        c0, c1 = rect.left()//cw, rect.right()//cw
+        r0, r1 = rect.top()//ch, rect.bottom()//ch
+
+        if c0 == c1 and r0 == r1:
+            return self.read_chunk(page, r0*cols+c0).copy(rect.translated(-c0*cw, -r0*ch))
+
+        img = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+        img.fill(Qt.transparent)
+        painter = QPainter(img)
+        for r in range(r0, r1+1):
+            for c in range(c0, c1+1):
+                painter.drawImage(c*cw-rect.x(), r*ch-rect.y(), self.read_chunk(page, r*cols+c))
+        painter.end()
+        return img
+
+""" PangoRawSource maps binary PGM/PPM files, which are raw uncompressed
+   rasters behind a short text header """
+class PangoRawSource(PangoRasterSource):
+    def __init__(self, fpath):
+        super().__init__(fpath)
+        head = self.mm[:1024]
+        if head[:2] not in (b"P5", b"P6"):
+            raise ValueError("Not a binary PGM/PPM file")
+
+        tokens, pos = [], 2
+        while len(tokens) < 3:
+            while head[pos:pos+1].isspace():
+                pos += 1
+            if head[pos:pos+1] == b"#":
+                pos = head.index(b"\n", pos)
+                continue
+            end = pos
+            while end < len(head) and not head[end:end+1].isspace():
+                end += 1
+            tokens.append(int(head[pos:end]))
+            pos = end
+        width, height, maxval = tokens
+        if maxval > 255:
+            raise ValueError("Only 8-bit PGM/PPM files are supported")
+
+        self.data_offset = pos+1 # Single whitespace after maxval
+        self.bpp = self.spp = 1 if head[:2] == b"P5" else 3
+        self.fmt = pango_qimage_format(self.bpp)
+        self._size = QSize(width, height)
+
+    def read_region(self, level, rect):
+        stride = self.size().width()*self.bpp
+        return pango_read_rows(self.mm, lambda y: self.data_offset+y*stride, rect, self.bpp, self.fmt)
+
+def pango_raster_source(fpath):
+    ext = os.path.splitext(fpath)[1].lower()
+    try:
+        if ext in (".tif", ".tiff"):
+            return PangoTiffSource(fpath)
+        elif ext in (".pgm", ".ppm"):
+            return PangoRawSource(fpath)
+    except (OSError, ValueError, KeyError, IndexError, struct.error):
+        return None
+    return None
+
+pango_sources = PangoLRUCache(8)
+pango_sources_lock = threading.Lock()
+
+# Sources which never decode the whole image at once. Originals read in
+# place come before pyramids, and sources are shared, so a file is opened
+# and mapped once
+def pango_tiled_source(fpath):
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    key = (os.path.abspath(fpath), st.st_size, st.st_mtime_ns)
+    with pango_sources_lock:
+        src = pango_sources.get(key)
+        if src is None:
+            src = pango_raster_source(fpath)
+            if src is None:
+                src = pango_pyramid_source(fpath)
+            if src is not None:
+                pango_sources.put(key, src)
+    return src
+
+def pango_image_source(fpath):
+    src = pango_tiled_source(fpath)
+    if src is not None:
+        return src
+
+    img = pango_read_image(fpath)
+    if img.isNull():
+        return None
+    return PangoQImageSource(img)
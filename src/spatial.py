@@ -0,0 +1,94 @@
+import math
+
+from PyQt5 import sip
+
+from .item import PangoBboxGraphic, PangoPolyGraphic
+
+pango_corners = ["topLeft", "topRight", "bottomLeft", "bottomRight"]
+
+""" PangoHandleIndex buckets polygon vertices and bbox corners of a scene's
+   shapes into a uniform grid, keyed by (shape, vertex index or corner name).
+   Commands update single handles, anything else marks the shape dirty and
+   it is re-read before the next query """
+class PangoHandleIndex(object):
+    def __init__(self, cell=40):
+        self.cell = cell
+        self.cells = {}
+        self.handles = {}
+        self.dirty = set()
+
+    def cell_of(self, x, y):
+        return math.floor(x/self.cell), math.floor(y/self.cell)
+
+    def handle(self, gfx, key):
+        if type(gfx) is PangoPolyGraphic:
+            if 0 <= key < gfx.poly.count():
+                p = gfx.poly.value(key)
+                return p.x(), p.y()
+        elif type(gfx) is PangoBboxGraphic:
+            p = getattr(gfx.rect, key)()
+            return p.x(), p.y()
+        return None
+
+    def keys(self, gfx):
+        if type(gfx) is PangoPolyGraphic:
+            return range(0, gfx.poly.count())
+        elif type(gfx) is PangoBboxGraphic:
+            return pango_corners
+        return []
+
+    def update(self, gfx, keys=None):
+        if keys is None:
+            self.remove(gfx)
+            keys = self.keys(gfx)
+        handles = self.handles.setdefault(gfx, {})
+        for key in keys:
+            old = handles.pop(key, None)
+            if old is not None:
+                cell = self.cells[self.cell_of(*old)]
+                cell.discard((gfx, key))
+                if not cell:
+                    del self.cells[self.cell_of(*old)]
+
+            pos = self.handle(gfx, key)
+            if pos is not None:
+                handles[key] = pos
+                self.cells.setdefault(self.cell_of(*pos), set()).add((gfx, key))
+        if not handles:
+            del self.handles[gfx]
+
+    def remove(self, gfx):
+        self.dirty.discard(gfx)
+        for key, pos in self.handles.pop(gfx, {}).items():
+            cell = self.cells[self.cell_of(*pos)]
+            cell.discard((gfx, key))
+            if not cell:
+                del self.cells[self.cell_of(*pos)]
+
+    def invalidate(self, gfx):
+        self.dirty.add(gfx)
+
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        for gfx in dirty:
+            if sip.isdeleted(gfx) or gfx.scene() is None:
+                self.remove(gfx)
+            else:
+                self.update(gfx)
+
+    # Nearest handle of a visible shape within radius, as (gfx, key)
+    def nearest(self, pos, radius):
+        self.flush()
+        x, y = pos.x(), pos.y()
+        x0, y0 = self.cell_of(x-radius, y-radius)
+        x1, y1 = self.cell_of(x+radius, y+radius)
+
+        nearest, min_dx = None, radius
+        for cx in range(x0, x1+1):
+            for cy in range(y0, y1+1):
+                for gfx, key in self.cells.get((cx, cy), ()):
+                    hx, hy = self.handles[gfx][key]
+                    dx = math.hypot(hx-x, hy-y)
+                    if dx < min_dx and gfx.isVisible():
+                        nearest, min_dx = (gfx, key), dx
+        return nearest
@@ -1,3 +1,4 @@
+import hashlib, os
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon, QPixmap, QColor
 
@@ -13,16 +14,45 @@ pango_palette = [QColor('#e6194b'), QColor('#3cb44b'), QColor('#ffe119'),
 
 pango_app_icon_color = QColor("grey")
 
+pango_image_formats = [".jpg", ".png", ".tif", ".tiff", ".pgm", ".ppm"]
+
 def pango_get_palette(n):
     return pango_palette[n % len(pango_palette)]
 
+# Icons are shared, every shape of a label shows the same one
+pango_icons = {}
+
 def pango_get_icon(name, color=None):
-    fn = ":/icons/"+name.lower().replace(" ", "_")+".png"
-    px = QPixmap(fn)
-    mask = px.createMaskFromColor(QColor('white'), Qt.MaskOutColor)
-    px.fill(pango_app_icon_color if color is None else color)
-    px.setMask(mask)
-    return QIcon(px)
+    color = pango_app_icon_color if color is None else QColor(color)
+    key = (name, color.rgba())
+    if key not in pango_icons:
+        fn = ":/icons/"+name.lower().replace(" ", "_")+".png"
+        px = QPixmap(fn)
+        mask = px.createMaskFromColor(QColor('white'), Qt.MaskOutColor)
+        px.fill(color)
+        px.setMask(mask)
+        pango_icons[key] = QIcon(px)
+    return pango_icons[key]
+
+def pango_is_image(fpath):
+    return fpath.lower().endswith(tuple(pango_image_formats))
+
+# Image annotated by an exported annotation file, i.e. with the same name
+def pango_find_image(fpath):
+    pre, ext = os.path.splitext(fpath)
+    for ext in pango_image_formats:
+        if os.path.exists(pre+ext):
+            return pre+ext
+    return None
+
+def pango_cache_dir(fpath, name):
+    return os.path.join(os.path.dirname(os.path.abspath(fpath)), ".pangolin", name)
+
+# Changes whenever the file is replaced or modified
+def pango_file_key(fpath):
+    st = os.stat(fpath)
+    key = "%s:%d:%d" % (os.path.abspath(fpath), st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(key.encode()).hexdigest()
 
 def pango_item_role_debug(role):
     return role_list[role]
@@ -0,0 +1,72 @@
+import os, pytest, time
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QColor, QImage
+
+from src.cache import PangoImageCache, PangoMetadataCache, PangoThumbnailCache
+
+@pytest.fixture
+def fpaths(tmp_path):
+    fpaths = []
+    for n in range(0, 4):
+        img = QImage(QSize(100, 100), QImage.Format_RGB32)
+        img.fill(QColor(n, n, n))
+        fpaths.append(str(tmp_path / (str(n)+".png")))
+        img.save(fpaths[-1])
+    return fpaths
+
+def settle(cache):
+    while cache.pending:
+        time.sleep(0.01)
+
+def test_image_cache(fpaths):
+    cache = PangoImageCache()
+    assert cache.fetch(fpaths[0]) is None # Decoded on a worker
+    settle(cache)
+    assert cache.fetch(fpaths[0]).pixelColor(0, 0) == QColor(0, 0, 0)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.prefetch(fpaths[1:3])
+    settle(cache)
+    assert cache.fetch(fpaths[2]).pixelColor(0, 0) == QColor(2, 2, 2)
+    assert cache.fetch(fpaths[1]).pixelColor(0, 0) == QColor(1, 1, 1)
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.shutdown()
+
+def test_image_cache_budget(fpaths):
+    cache = PangoImageCache(budget=2*100*100*4)
+    for fpath in fpaths:
+        cache.fetch(fpath)
+        settle(cache)
+
+    assert len(cache.images) == 2
+    assert fpaths[0] not in cache.images
+    assert fpaths[3] in cache.images
+    cache.shutdown()
+
+def test_metadata_cache(fpaths, tmp_path):
+    cache = PangoMetadataCache()
+    info = cache.info(fpaths[0])
+    assert (info["width"], info["height"], info["format"]) == (100, 100, "png")
+    assert cache.size(fpaths[1]) == QSize(100, 100)
+    cache.save()
+    assert os.path.exists(str(tmp_path / ".pangolin" / "metadata.json"))
+
+    # Served from disk, until the file changes
+    cache = PangoMetadataCache()
+    assert cache.folder(fpaths[0])[1]["0.png"]["width"] == 100
+    QImage(QSize(50, 20), QImage.Format_Grayscale8).save(fpaths[0])
+    info = cache.info(fpaths[0])
+    assert (info["width"], info["height"], info["depth"]) == (50, 20, 1)
+
+def test_thumbnail_cache_unwritable(fpaths, tmp_path):
+    open(str(tmp_path / ".pangolin"), "w").close() # No cache folder can be made
+    cache = PangoThumbnailCache(QSize(50, 50))
+    loaded = []
+    cache.loaded.connect(lambda fpath, img: loaded.append((fpath, img)))
+    cache.pending.add(fpaths[0])
+    cache.load(fpaths[0])
+
+    assert loaded[0][0] == fpaths[0]
+    assert loaded[0][1].size() == QSize(50, 50)
+    assert not cache.pending
@@ -1,8 +1,13 @@
+import os
 import pytest
 from pytestqt.qt_compat import qt_api
 
+from src.cache import pango_thumbnail_path
 from src.dock import PangoDockWidget
+from src.graphics import CreateShape, ExtendShape, MoveShape
+from src.item import PangoBboxGraphic, PangoPathGraphic
 
+from PyQt5.QtCore import QModelIndex
 from PyQt5.QtWidgets import QFileSystemModel, QListView
 
 def test_basic_dock(app):
@@ -18,14 +23,143 @@ def test_basic_dock(app):
 def test_label_dock(app):
     assert app.label_widget.widget() == app.label_widget.tree_view
 
-def test_undo_dock(app):
+def test_undo_dock(app, tmp_path):
     assert app.undo_widget.widget() == app.undo_widget.undo_view
 
-    # TODO: Add this when project saves undo stack too
-    # app.undo_widget.redo()
-    # assert app.undo_widget.undo_view.currentIndex().row() == 1
-    # app.undo_widget.undo()
-    # assert app.undo_widget.undo_view.currentIndex().row() == 0
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(10, 10), scene.active_label)
+    scene.push(com)
+    app.save_project(project_path=str(tmp_path / "project.p"))
+    app.load_project(project_path=str(tmp_path / "project.p"))
+
+    # Saved with the project, so there is a step to undo
+    view = app.undo_widget.undo_view
+    assert view.currentIndex().row() == 1
+    app.undo_widget.undo()
+    assert view.currentIndex().row() == 0
+    app.undo_widget.redo()
+    assert view.currentIndex().row() == 1
+
+def test_undo_model(app):
+    scene = app.interface.scene
+    view = app.undo_widget.undo_view
+    model = view.model()
+    app.tool_bar.add_action.trigger()
+    scene.merge_strokes = False
+    count = scene.stack.count()
+    rows = model.rowCount()
+
+    com = CreateShape(PangoPathGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    for n in range(0, 100):
+        scene.push(ExtendShape(qt_api.QtCore.QPointF(n, n), com.gfx, "lineTo"))
+    assert scene.stack.count() == count+101
+    assert model.rowCount() == rows+2 # Creation, then one row for the stroke
+
+    stroke = model.index(rows+1, 0)
+    assert model.rowCount(stroke) == 100
+    assert model.data(stroke).endswith("(100 steps)")
+    assert model.data(model.index(0, 0, stroke)) == "Extended "+com.gfx.name+" to (0, 0)"
+    assert view.currentIndex() == stroke
+
+    # Selecting a step rewinds the stack, pushing then drops the redo rows
+    view.setCurrentIndex(model.index(49, 0, stroke))
+    assert scene.stack.index() == count+51
+    scene.push(MoveShape(qt_api.QtCore.QPointF(0, 0), com.gfx, 0))
+    assert model.rowCount(stroke) == 50
+    assert model.rowCount() == rows+3
+
+    view.setCurrentIndex(model.index(0, 0))
+    assert scene.stack.index() == 0
+
+def test_undo_model_macros(app):
+    scene = app.interface.scene
+    model = app.undo_widget.undo_view.model()
+    app.tool_bar.add_action.trigger()
+    scene.merge_strokes = False
+    count = scene.stack.count()
+    rows = model.rowCount()
+
+    com = CreateShape(PangoPathGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    for n in range(0, 5):
+        scene.push(ExtendShape(qt_api.QtCore.QPointF(n, n), com.gfx, "lineTo"))
+    for text in ("First", "Second"):
+        scene.stack.beginMacro(text)
+        scene.push(ExtendShape(qt_api.QtCore.QPointF(9, 9), com.gfx, "lineTo"))
+        scene.stack.endMacro()
+    assert model.rowCount() == rows+2 # Macros on the stroke's shape join its row
+    stroke = model.index(rows+1, 0)
+    assert model.rowCount(stroke) == 7
+    assert model.data(model.index(6, 0, stroke)) == "Second"
+    assert model.data(stroke) == "Second (7 steps)"
+    assert scene.stack.index() == count+8
+
+    # Opening a macro drops the redo commands without moving the index
+    for n in range(0, 3):
+        scene.stack.undo()
+    scene.stack.beginMacro("Third")
+    assert model.rowCount() == rows+3
+    assert model.rowCount(model.index(rows+2, 0)) == 0
+    for r in range(0, model.rowCount()):
+        model.data(model.index(r, 0))
+    scene.stack.endMacro()
+    assert scene.stack.count() == count+6
+    assert scene.stack.index() == count+6 # Not undone by the view
+    assert model.data(model.index(rows+2, 0)) == "Third"
+
+def test_image_tree_model(app):
+    itf = app.interface
+    scene = itf.scene
+    model = itf.tree_model
+    model.chunk_size = 4
+    app.tool_bar.add_action.trigger()
+
+    gfxs = {}
+    for fpath in ("a.jpg", "b.jpg", "a.jpg"):
+        scene.fpath = fpath
+        for n in range(0, 5):
+            com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(n, n), scene.active_label)
+            scene.push(com)
+            gfxs.setdefault(fpath, []).append(com.gfx)
+
+    itf.filter_tree("a.jpg", "b.jpg")
+    label = model.index(0, 0)
+    assert model.rowCount(label) == 4 # One chunk, the rest is fetched on demand
+    assert model.canFetchMore(label)
+    model.fetchMore(label)
+    assert model.rowCount(label) == 8
+    model.fetchMore(label)
+    assert model.rowCount(label) == 10 and not model.canFetchMore(label)
+
+    rows = [itf.map[qt_api.QtCore.QPersistentModelIndex(model.mapToSource(model.index(row, 0, label)))]
+            for row in range(0, 10)]
+    assert rows == gfxs["a.jpg"]
+    assert model.data(model.index(0, 0, label)) == gfxs["a.jpg"][0].name
+    icons = [model.data(model.index(row, 0, label), qt_api.QtCore.Qt.DecorationRole) for row in (0, 9)]
+    assert icons[0].cacheKey() == icons[1].cacheKey() # Shared, not one pixmap per shape
+
+    # New and removed shapes of the shown image come and go in place
+    scene.push(CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label))
+    assert model.rowCount(label) == 11
+    scene.stack.undo()
+    assert model.rowCount(label) == 10
+
+    # Removing a hidden shape moves the rows of the shown ones after it
+    key = itf.map.inverse[gfxs["b.jpg"].pop(0)]
+    itf.model.removeRow(key.row(), key.parent())
+    rows = [itf.map[qt_api.QtCore.QPersistentModelIndex(model.mapToSource(model.index(row, 0, label)))]
+            for row in range(0, 10)]
+    assert rows == gfxs["a.jpg"]
+    idx = model.mapFromSource(QModelIndex(itf.map.inverse[gfxs["a.jpg"][7]]))
+    assert idx.row() == 7 and idx.parent() == label
+
+    itf.filter_tree("b.jpg", "a.jpg")
+    assert model.rowCount(label) == 4
+    idx = model.mapFromSource(QModelIndex(itf.map.inverse[gfxs["b.jpg"][2]]))
+    assert idx.row() == 2 and idx.parent() == label
+    assert not model.mapFromSource(QModelIndex(itf.map.inverse[gfxs["a.jpg"][2]])).isValid()
 
 def test_file_dock(app):
     assert app.file_widget.widget() == app.file_widget.file_view
@@ -39,3 +173,22 @@ def test_file_dock(app):
     app.file_widget.select_prev_image()
     assert app.file_widget.file_view.currentIndex().row() == 0
 
+
+def test_thumbnails(app, qtbot, monkeypatch):
+    provider = app.file_widget.th_provider
+    fpath = app.file_widget.file_model.filePath(app.file_widget.file_view.currentIndex())
+
+    qtbot.waitUntil(lambda: fpath in provider.thumbnails)
+    icon = provider.thumbnail(fpath)
+    assert icon is not provider.placeholder
+    assert max(icon.availableSizes()[0].width(), icon.availableSizes()[0].height()) == 150
+
+    # Second load comes from the disk cache, the image isn't decoded again
+    assert os.path.isfile(pango_thumbnail_path(fpath))
+    def decode(*args):
+        raise AssertionError("decoded "+fpath)
+    monkeypatch.setattr("src.cache.pango_tiled_source", decode)
+    monkeypatch.setattr("src.cache.pango_read_preview", decode)
+    provider.thumbnails.clear()
+    assert provider.thumbnail(fpath) is provider.placeholder
+    qtbot.waitUntil(lambda: fpath in provider.thumbnails)
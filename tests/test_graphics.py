@@ -1,26 +1,12 @@
-import pytest
+import pytest, shutil
 from pytestqt.qt_compat import qt_api
 
+from array import array
 from random import random
 from app import MainWindow
-
-# TODO: Add this when project saves stack too
-# def test_stack(app, qtbot, delay=25):
-#     test_poly_tool(app, qtbot, delay=10)
-#     for _ in range(0, 100):
-#         app.interface.scene.stack.setIndex(int(random()*app.interface.scene.stack.count()-1))
-#         qtbot.wait(delay)
-#     assert app.interface.scene.stack.count() == 789
-# 
-#     qtbot.wait(1000)
-# 
-#     test_bbox_tool(app, qtbot, delay=25)
-#     for _ in range(0, 100):
-#         app.interface.scene.stack.setIndex(int(random()*app.interface.scene.stack.count()-1))
-#         qtbot.wait(delay)
-#     assert app.interface.scene.stack.count() == 16
-# 
-#     qtbot.wait(1000)
+from src.graphics import CreateShape, ExtendShape, MoveShape
+from src.history import BEGIN_MACRO, END_MACRO, EXTEND, pango_restore_history
+from src.item import PangoBboxGraphic, PangoPathGraphic, PangoPolyGraphic
 
 def test_bbox_tool(app, qtbot, delay=25, n_drag_points=10):
     app.file_widget.file_view.setCurrentIndex(
@@ -271,3 +257,374 @@ def test_poly_tool(app, qtbot, delay=10):
 
     qtbot.wait(1000)
     assert app.interface.scene.stack.count() == 789
+
+def test_switch_image(app, qtbot):
+    scene = app.interface.scene
+    app.file_widget.file_view.setCurrentIndex(
+            app.file_widget.file_model.index("tests/resources/zoo.jpg"))
+
+    # Layout comes from the header, before pixels are decoded
+    assert scene.sceneRect() == qt_api.QtCore.QRectF(0, 0, 1000, 667)
+    qtbot.waitUntil(lambda: scene.image.source is not None)
+    assert scene.image.size() == qt_api.QtCore.QSize(1000, 667)
+
+    app.file_widget.select_prev_image()
+    app.file_widget.select_next_image()
+    assert scene.image.source is not None
+    assert scene.image_cache.hits > 0
+
+def test_unsized_image(app, qtbot, monkeypatch, tmp_path):
+    scene = app.interface.scene
+    fpath = str(tmp_path / "road.jpg")
+    shutil.copy("tests/resources/road.jpg", fpath)
+    monkeypatch.setattr(scene.metadata, "size", lambda fpath: qt_api.QtCore.QSize())
+    scene.set_fpath(fpath)
+    assert not scene.image.size().isValid()
+
+    # Laid out once decoded
+    qtbot.waitUntil(lambda: scene.image.source is not None)
+    assert scene.sceneRect() == qt_api.QtCore.QRectF(0, 0, 4450, 2286)
+    assert scene.context.size == qt_api.QtCore.QSize(4450, 2286)
+
+def test_label_overlay(app, qtbot):
+    app.file_widget.file_view.setCurrentIndex(
+            app.file_widget.file_model.index("tests/resources/road.jpg"))
+    app.tool_bar.bbox_action.trigger()
+    app.tool_bar.add_action.trigger()
+
+    scene = app.interface.scene
+    label = scene.active_label
+
+    def render():
+        img = qt_api.QtGui.QImage(500, 500, qt_api.QtGui.QImage.Format_ARGB32)
+        painter = qt_api.QtGui.QPainter(img)
+        scene.render(painter, qt_api.QtCore.QRectF(img.rect()), qt_api.QtCore.QRectF(0, 0, 500, 500))
+        painter.end()
+
+    render()
+    assert label.overlay is None # No shapes to draw
+
+    bbox = PangoBboxGraphic()
+    bbox.rect = qt_api.QtCore.QRectF(100, 100, 400, 400)
+    bbox.setParentItem(label)
+    label.overlay_margin = 10
+    render()
+    assert label.overlay is not None
+    assert label.overlay.width() <= 520
+    assert bbox.flags() & qt_api.QtWidgets.QGraphicsItem.ItemHasNoContents
+    assert bbox in scene.items(qt_api.QtCore.QPointF(100, 100))
+
+    # Only the changed shape's area is redrawn
+    bbox.prepareGeometryChange()
+    bbox.rect = qt_api.QtCore.QRectF(150, 150, 50, 50)
+    bbox.update()
+    assert not label.dirty.isEmpty()
+    assert label.dirty.boundingRect().width() < label.overlay.width()
+    render()
+    assert label.dirty.isEmpty()
+
+    bbox.setSelected(True)
+    assert not bbox.flags() & qt_api.QtWidgets.QGraphicsItem.ItemHasNoContents
+
+def test_bbox_lod(app, qtbot, monkeypatch):
+    app.file_widget.file_view.setCurrentIndex(
+            app.file_widget.file_model.index("tests/resources/road.jpg"))
+    app.tool_bar.add_action.trigger()
+
+    scene = app.interface.scene
+    bbox = PangoBboxGraphic()
+    bbox.rect = qt_api.QtCore.QRectF(100, 100, 400, 400)
+    bbox.setParentItem(scene.active_label)
+
+    captions = []
+    monkeypatch.setattr(PangoBboxGraphic, "paint_text_rect", lambda self, painter: captions.append(self))
+
+    def render(scale):
+        img = qt_api.QtGui.QImage(200, 200, qt_api.QtGui.QImage.Format_ARGB32)
+        painter = qt_api.QtGui.QPainter(img)
+        scene.render(painter, qt_api.QtCore.QRectF(0, 0, 200, 200),
+                qt_api.QtCore.QRectF(0, 0, 200/scale, 200/scale))
+        painter.end()
+
+    render(1)
+    assert captions == [bbox]
+    render(PangoBboxGraphic.lod_text/2)
+    assert captions == [bbox]
+
+def test_draft_mode(app, qtbot):
+    scene = app.interface.scene
+    event = qt_api.QtGui.QWheelEvent(
+            qt_api.QtCore.QPointF(10, 10), qt_api.QtCore.QPointF(10, 10),
+            qt_api.QtCore.QPoint(0, 0), qt_api.QtCore.QPoint(0, 120),
+            qt_api.QtCore.Qt.NoButton, qt_api.QtCore.Qt.NoModifier,
+            qt_api.QtCore.Qt.NoScrollPhase, False)
+    qt_api.QtCore.QCoreApplication.sendEvent(app.graphics_view.viewport(), event)
+
+    assert scene.draft
+    qtbot.waitUntil(lambda: not scene.draft, timeout=1000)
+
+def test_cached_geometry(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    bbox = PangoBboxGraphic()
+    bbox.rect = qt_api.QtCore.QRectF(100, 100, 50, 50)
+    bbox.setParentItem(scene.active_label)
+
+    rect = bbox.boundingRect()
+    assert bbox.shape() is bbox.shape()
+
+    com = MoveShape(qt_api.QtCore.QPointF(300, 300), bbox, corner="bottomRight")
+    com.redo()
+    assert bbox.boundingRect().contains(qt_api.QtCore.QPointF(290, 290))
+    com.undo()
+    assert bbox.boundingRect() == rect
+
+def test_path_stroke_merging(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    create = CreateShape(PangoPathGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.stack.push(create)
+    path = create.gfx.path
+
+    scene.stack.beginMacro("Stroke")
+    scene.stack.push(ExtendShape(qt_api.QtCore.QPointF(0, 0), create.gfx, "moveTo"))
+    for n in range(1, 101):
+        scene.stack.push(ExtendShape(qt_api.QtCore.QPointF(n, n), create.gfx, "lineTo"))
+    scene.stack.endMacro()
+
+    assert scene.stack.command(1).childCount() == 2
+    assert path.elementCount() == 101
+
+    scene.stack.undo()
+    assert path.elementCount() == 0
+    scene.stack.redo()
+    assert path.elementCount() == 101
+    assert path.currentPosition() == qt_api.QtCore.QPointF(100, 100)
+
+def test_click_then_stroke(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    QPointF = qt_api.QtCore.QPointF
+    scene.merge_strokes = False
+
+    create = CreateShape(PangoPathGraphic, QPointF(0, 0), scene.active_label)
+    scene.push(create)
+    path = create.gfx.path
+    scene.push(ExtendShape(QPointF(0, 0), create.gfx, "moveTo")) # A click, nothing drawn
+    scene.push(ExtendShape(QPointF(50, 50), create.gfx, "moveTo")) # Replaces the click's moveTo
+    scene.push(ExtendShape(QPointF(60, 60), create.gfx, "lineTo"))
+    assert path.elementCount() == 2
+
+    scene.stack.undo()
+    scene.stack.undo()
+    assert path.elementCount() == 1
+    assert path.currentPosition() == QPointF(0, 0)
+    scene.stack.undo()
+    assert path.elementCount() == 0
+
+def test_live_drag(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    bbox = PangoBboxGraphic()
+    bbox.rect = qt_api.QtCore.QRectF(100, 100, 50, 50)
+    bbox.setParentItem(scene.active_label)
+    count = scene.stack.count()
+
+    scene.begin_drag(MoveShape(qt_api.QtCore.QPointF(150, 150), bbox, corner="bottomRight"))
+    for n in range(0, 50):
+        scene.drag_com.drag(qt_api.QtCore.QPointF(150+n, 150+n))
+    assert scene.stack.count() == count
+    assert bbox.rect.bottomRight() == qt_api.QtCore.QPointF(199, 199)
+
+    scene.reset_com()
+    assert scene.stack.count() == count+1
+    scene.stack.undo()
+    assert bbox.rect.bottomRight() == qt_api.QtCore.QPointF(150, 150)
+
+def test_unravel_shapes(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    count = scene.stack.count()
+
+    gfxs = []
+    for n in range(0, 2):
+        com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(n, n), scene.active_label)
+        scene.push(com)
+        scene.push(MoveShape(qt_api.QtCore.QPointF(100, 100), com.gfx, corner="bottomRight"))
+        gfxs.append(com.gfx)
+    moved = []
+    gfxs[0].update = lambda *args: moved.append(args) # Untouched by unravelling gfxs[1]
+
+    scene.unravel_shapes(gfxs[1])
+    assert gfxs[1].scene() is None
+    assert gfxs[0].scene() is scene
+    assert scene.stack.count() == count+2
+    assert moved == []
+
+    # Now on top of the stack, so dropped right away
+    scene.unravel_shapes(gfxs[0])
+    assert gfxs[0].scene() is None
+    assert scene.stack.count() == count
+
+def test_bounded_history(app, qtbot):
+    scene = app.interface.scene
+    scene.undo_limit = 5
+    scene.history_budget = 8
+    app.tool_bar.add_action.trigger()
+    bbox = PangoBboxGraphic()
+    bbox.rect = qt_api.QtCore.QRectF(0, 0, 10, 10)
+
+    scene.stack = scene.stack_for("a.jpg")
+    for n in range(0, 10):
+        scene.push(MoveShape(qt_api.QtCore.QPointF(20+n, 20+n), bbox, corner="bottomRight"))
+    assert scene.stack.count() == 5
+    assert bbox.rect.bottomRight() == qt_api.QtCore.QPointF(29, 29)
+    scene.stack.setClean()
+
+    scene.stack = scene.stack_for("b.jpg")
+    for n in range(0, 5):
+        scene.push(MoveShape(qt_api.QtCore.QPointF(n, n), bbox, corner="topLeft"))
+    scene.stack = scene.stack_for("c.jpg")
+
+    # Least recently used and clean, so compacted
+    assert scene.change_stacks["a.jpg"].count() == 0
+    assert scene.change_stacks["b.jpg"].count() == 5
+    assert bbox.rect.bottomRight() == qt_api.QtCore.QPointF(29, 29)
+    assert len(scene.commands[bbox]) == 5 # Only those still in a stack
+
+def test_unravel_dropped_macro(app, qtbot):
+    scene = app.interface.scene
+    scene.undo_limit = 1
+    app.tool_bar.add_action.trigger()
+    scene.stack = scene.stack_for("a.jpg")
+
+    scene.stack.beginMacro("Drawn")
+    com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    scene.push(MoveShape(qt_api.QtCore.QPointF(100, 100), com.gfx, corner="bottomRight"))
+    scene.stack.endMacro()
+    other = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.push(other) # Over the limit, the macro is dropped
+    assert scene.stack.count() == 1
+
+    scene.unravel_shapes(com.gfx)
+    assert com.gfx.scene() is None
+    assert other.gfx.scene() is scene
+
+def test_saved_history(app, qtbot, tmp_path):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    count = scene.stack.count()
+
+    com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(10, 10), scene.active_label)
+    scene.push(com)
+    old_pos = com.gfx.rect.bottomRight()
+    scene.push(MoveShape(qt_api.QtCore.QPointF(50, 50), com.gfx, corner="bottomRight"))
+
+    app.save_project(project_path=str(tmp_path / "project.p"))
+    app.load_project(project_path=str(tmp_path / "project.p"))
+    assert scene.stack.count() == count+2
+    assert scene.stack.isClean()
+
+    bbox = [gfx for gfx in app.interface.map.values() if type(gfx) is PangoBboxGraphic][0]
+    assert bbox is not com.gfx
+    assert bbox.rect.bottomRight() == qt_api.QtCore.QPointF(50, 50)
+    scene.stack.undo()
+    assert bbox.rect.bottomRight() == old_pos
+    scene.stack.undo()
+    assert bbox.scene() is None
+
+def test_compacted_history(app, qtbot, tmp_path):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    fpath = scene.fpath
+    com = CreateShape(PangoBboxGraphic, qt_api.QtCore.QPointF(10, 10), scene.active_label)
+    scene.push(com)
+    old_pos = com.gfx.rect.bottomRight()
+    scene.push(MoveShape(qt_api.QtCore.QPointF(50, 50), com.gfx, corner="bottomRight"))
+    app.save_project(project_path=str(tmp_path / "project.p"))
+    app.load_project(project_path=str(tmp_path / "project.p"))
+
+    # Restored, then compacted away once another image is opened
+    scene.history_budget = 0
+    app.file_widget.select_next_image()
+    assert scene.change_stacks[fpath].count() == 0
+    app.file_widget.select_prev_image()
+    assert scene.fpath == fpath and scene.stack.count() == 2
+
+    bbox = [gfx for gfx in app.interface.map.values() if type(gfx) is PangoBboxGraphic][0]
+    scene.stack.undo()
+    assert bbox.rect.bottomRight() == old_pos
+
+def test_restore_missing_shapes(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    count = scene.stack.count()
+    com = CreateShape(PangoPathGraphic, qt_api.QtCore.QPointF(0, 0), scene.active_label)
+    scene.push(com)
+
+    points = array("d", (1, 1, 2, 2))
+    pango_restore_history(scene, [(BEGIN_MACRO, "Lost"), (EXTEND, None, 2, points), (END_MACRO,),
+        (BEGIN_MACRO, "Kept"), (EXTEND, None, 2, points), (EXTEND, com.gfx, 2, points), (END_MACRO,)], "")
+    assert scene.stack.count() == count+2 # No empty macro
+    assert scene.stack.command(count+1).text() == "Kept"
+    assert scene.stack.command(count+1).childCount() == 1
+
+def test_handle_index(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    QPointF = qt_api.QtCore.QPointF
+
+    com = CreateShape(PangoPolyGraphic, QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    poly = com.gfx
+    for n in range(0, 1000):
+        scene.push(ExtendShape(QPointF(n, 100), poly))
+    com = CreateShape(PangoBboxGraphic, QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    bbox = com.gfx
+    scene.push(MoveShape(QPointF(500, 90), bbox, corner="topLeft"))
+    scene.push(MoveShape(QPointF(600, 200), bbox, corner="bottomRight"))
+
+    # Overlapping shapes, the nearest handle wins
+    assert scene.handles.nearest(QPointF(250.2, 101), 20) == (poly, 250)
+    assert scene.handles.nearest(QPointF(499, 91), 20) == (bbox, "topLeft")
+    assert scene.handles.nearest(QPointF(601, 90), 20) == (bbox, "topRight")
+    assert scene.handles.nearest(QPointF(300, 150), 20) is None
+
+    scene.push(MoveShape(QPointF(300, 150), poly, idx=10))
+    assert scene.handles.nearest(QPointF(300, 149), 20) == (poly, 10)
+    scene.stack.undo()
+    assert scene.handles.nearest(QPointF(10, 101), 5) == (poly, 10)
+
+    bbox.setVisible(False)
+    assert scene.handles.nearest(QPointF(601, 90), 5) is None
+    scene.removeItem(poly)
+    assert scene.handles.nearest(QPointF(250, 100), 20) is None
+
+def test_stroke_geometry(app, qtbot):
+    scene = app.interface.scene
+    app.tool_bar.add_action.trigger()
+    QPointF = qt_api.QtCore.QPointF
+
+    com = CreateShape(PangoPathGraphic, QPointF(0, 0), scene.active_label)
+    scene.push(com)
+    path = com.gfx
+    scene.push(ExtendShape(QPointF(0, 0), path, "moveTo"))
+    path.boundingRect()
+
+    changes = []
+    prepare = path.prepareGeometryChange
+    path.prepareGeometryChange = lambda: changes.append(1) or prepare()
+    for n in range(1, 1001):
+        scene.push(ExtendShape(QPointF(n, n%7), path, "lineTo"))
+
+    # The bounding rect grows with slack, so the index is rarely updated
+    assert len(changes) < 20
+    assert path.boundingRect().contains(QPointF(1000, 6))
+    assert path.shape().contains(QPointF(500, 500%7))
+
+    path.settle_geometry()
+    w = path.path.width/2
+    assert path.boundingRect().right() < 1000+w+1
+    assert len(path.path_chunks()) > 1
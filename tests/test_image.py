@@ -0,0 +1,138 @@
+import os, pytest, struct, zlib
+
+from PyQt5.QtCore import QRect, QRectF, QSize, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter, QTransform
+
+from src.cache import pango_write_pyramid
+from src.image import (PangoLRUCache, PangoPyramidSource, PangoQImageSource, PangoTiledImage,
+        pango_pyramid_dir, pango_pyramid_source, pango_read_preview)
+from src.raster import PangoRawSource, PangoTiffSource, pango_image_source, pango_raster_source, pango_tiled_source
+
+def test_lru_cache():
+    cache = PangoLRUCache(3)
+    for k in "abc":
+        cache.put(k, k)
+    cache.get("a")
+    cache.put("d", "d")
+
+    assert "b" not in cache
+    assert "a" in cache and "d" in cache
+    assert len(cache) == 3
+
+def test_pyramid_levels():
+    src = PangoQImageSource(QImage(QSize(2000, 1000), QImage.Format_RGB32))
+
+    assert src.level_count() == 3
+    assert src.level_size(2) == QSize(500, 250)
+    assert src.tile_count(0) == (4, 2)
+    assert src.tile(0, 3, 1).size() == QSize(2000-3*512, 1000-512)
+
+    # Downsampled levels stay within their budget, rebuilt when needed
+    img = QImage(QSize(2000, 1000), QImage.Format_RGB32)
+    img.fill(QColor("blue"))
+    src = PangoQImageSource(img)
+    src.levels.capacity = 500*250*4
+    assert src.tile(2, 0, 0).pixelColor(10, 10) == QColor("blue")
+    assert list(src.levels.entries) == [2]
+    assert src.tile(1, 1, 0).size() == QSize(1000-512, 500)
+    assert list(src.levels.entries) == [1]
+
+def test_draw_visible_tiles(qapp):
+    img = QImage(QSize(2000, 1000), QImage.Format_RGB32)
+    img.fill(QColor("red"))
+    tiled = PangoTiledImage()
+    tiled.set_source(PangoQImageSource(img))
+
+    out = QImage(QSize(100, 100), QImage.Format_RGB32)
+    out.fill(QColor("black"))
+    painter = QPainter(out)
+    tiled.draw(painter, QRectF(0, 0, 100, 100))
+    painter.end()
+
+    assert out.pixelColor(50, 50) == QColor("red")
+    assert set(tiled.tiles.entries.keys()) == {(0, 0, 0)}
+
+    # Zoomed out, coarser tiles are picked
+    out = QImage(QSize(250, 125), QImage.Format_RGB32)
+    painter = QPainter(out)
+    painter.setWorldTransform(QTransform.fromScale(0.125, 0.125))
+    tiled.draw(painter, QRectF(0, 0, 2000, 1000))
+    painter.end()
+
+    assert (2, 0, 0) in tiled.tiles
+
+def test_pyramid_cache(tmp_path):
+    fpath = str(tmp_path / "big.png")
+    img = QImage(QSize(3000, 1000), QImage.Format_RGB32)
+    img.fill(QColor("blue"))
+    img.save(fpath)
+
+    assert pango_pyramid_source(fpath) is None
+    pango_write_pyramid(fpath)
+
+    src = pango_image_source(fpath)
+    assert type(src) is PangoPyramidSource
+    assert src.size() == QSize(3000, 1000)
+    assert src.tile(0, 5, 1).size() == QSize(3000-5*512, 1000-512)
+    assert src.tile(3, 0, 0).pixelColor(0, 0) == QColor("blue")
+
+    # Full resolution tiles of other lossless formats stay lossless
+    fpath = str(tmp_path / "big.bmp")
+    img.setPixelColor(1, 1, QColor(1, 2, 3))
+    img.save(fpath)
+    pango_write_pyramid(fpath)
+    src = pango_image_source(fpath)
+    assert src.tile_path(0, 0, 0).endswith(".png") and src.tile_path(1, 0, 0).endswith(".jpg")
+    assert src.tile(0, 0, 0).pixelColor(1, 1) == QColor(1, 2, 3)
+
+def test_preview(qapp):
+    img = pango_read_preview("tests/resources/zoo.jpg", QSize(100, 100))
+    assert img.size() == QSize(1000, 667).scaled(QSize(100, 100), Qt.KeepAspectRatio)
+
+    tiled = PangoTiledImage()
+    tiled.set_preview(img, QSize(1000, 667))
+    assert tiled.rect() == QRectF(0, 0, 1000, 667)
+    assert tiled.source is None
+
+def test_raster_sources(qapp, tmp_path):
+    img = QImage(QSize(1300, 700), QImage.Format_RGB888)
+    img.fill(QColor("green"))
+    for ext, cls in ((".tif", PangoTiffSource), (".ppm", PangoRawSource)):
+        fpath = str(tmp_path / ("big"+ext))
+        img.save(fpath)
+
+        src = pango_raster_source(fpath)
+        assert type(src) is cls
+        assert src.size() == QSize(1300, 700)
+        assert src.tile(0, 2, 1).size() == QSize(1300-2*512, 700-512)
+        assert src.tile(2, 0, 0).pixelColor(10, 10) == QColor("green")
+
+        # Read in place rather than through a pyramid, and opened once
+        pango_write_pyramid(fpath, min_size=512)
+        assert not os.path.exists(pango_pyramid_dir(fpath))
+        assert pango_tiled_source(fpath) is pango_tiled_source(fpath)
+
+def test_tiled_tiff(tmp_path):
+    # 2x2 tiles of 16px, deflate compressed, tile n filled with value n*50
+    def write(fpath, extra_tags=()):
+        tiles = [zlib.compress(bytes([n*50])*16*16) for n in range(0, 4)]
+        offsets, pos = [], 8+2+(10+len(extra_tags))*12+4
+        for t in tiles:
+            offsets.append(pos)
+            pos += len(t)
+        tags = [(256, 3, 1, 32), (257, 3, 1, 32), (258, 3, 1, 8), (259, 3, 1, 8), (262, 3, 1, 1),
+                (277, 3, 1, 1), (322, 3, 1, 16), (323, 3, 1, 16), (324, 4, 4, pos), (325, 4, 4, pos+16)]
+        tags = sorted(tags+list(extra_tags))
+        data = b"II"+struct.pack("<HI", 42, 8)+struct.pack("<H", len(tags))
+        data += b"".join(struct.pack("<HHII", *t) for t in tags)+struct.pack("<I", 0)
+        data += b"".join(tiles)+struct.pack("<4I", *offsets)+struct.pack("<4I", *map(len, tiles))
+        fpath.write_bytes(data)
+        return str(fpath)
+
+    src = pango_raster_source(write(tmp_path / "tiled.tif"))
+    assert src.tile_size == 16
+    assert src.tile(0, 1, 1).pixelColor(0, 0) == QColor(150, 150, 150)
+    assert src.read_region(0, QRect(8, 8, 16, 16)).pixelColor(15, 15) == QColor(150, 150, 150)
+
+    # Differenced samples are left to QImage
+    assert pango_raster_source(write(tmp_path / "predictor.tif", [(317, 3, 1, 2)])) is None
@@ -1,6 +1,9 @@
 import pytest
 
-from PyQt5.QtCore import QItemSelectionModel
+from PyQt5.QtCore import QItemSelectionModel, QPointF
+
+from src.graphics import CreateShape, MoveShape
+from src.item import PangoBboxGraphic
 
 def test_basic_interface(app_anno, qtbot):
     assert len(app_anno.interface.map) > 0
@@ -16,3 +19,125 @@ def test_selection(app_anno, qtbot):
     #     itf.tree.selectionModel().select(idx, QItemSelectionModel.Select)
 
     # qtbot.mousePress(app.graphics_view.viewport(), qt_api.QtCore.Qt.LeftButton, pos=p1)
+
+def test_fpath_index(app, qtbot):
+    itf = app.interface
+    scene = itf.scene
+    app.tool_bar.add_action.trigger()
+
+    gfxs = {}
+    for fpath in ("a.jpg", "b.jpg"):
+        scene.fpath = fpath
+        for n in range(0, 3):
+            com = CreateShape(PangoBboxGraphic, QPointF(n, n), scene.active_label)
+            scene.push(com)
+            gfxs.setdefault(fpath, []).append(com.gfx)
+
+    assert [itf.map[item.key()] for item in itf.items_for("a.jpg")] == gfxs["a.jpg"]
+    assert len(itf.items_for("b.jpg")) == 3
+
+    itf.filter_tree("a.jpg", "b.jpg")
+    assert all(gfx.scene() is scene for gfx in gfxs["a.jpg"])
+    assert all(gfx.scene() is None for gfx in gfxs["b.jpg"])
+
+    # Only shapes of the two images are looked up
+    lookups = []
+    itf.items_for = lambda fpath, f=itf.items_for: lookups.append(fpath) or f(fpath)
+    itf.filter_tree("b.jpg", "a.jpg")
+    assert sorted(lookups) == ["a.jpg", "b.jpg"]
+    assert all(gfx.scene() is None for gfx in gfxs["a.jpg"])
+    assert all(gfx.scene() is scene for gfx in gfxs["b.jpg"])
+
+    scene.stack.undo() # Removes the last shape
+    assert [itf.map[item.key()] for item in itf.items_for("b.jpg")] == gfxs["b.jpg"][:2]
+
+def test_parked_images(app, qtbot):
+    itf = app.interface
+    scene = itf.scene
+    scene.park_limit = 1
+    app.tool_bar.add_action.trigger()
+
+    gfxs = {}
+    for fpath in ("a.jpg", "b.jpg", "c.jpg"):
+        scene.fpath = fpath
+        com = CreateShape(PangoBboxGraphic, QPointF(0, 0), scene.active_label)
+        scene.push(com)
+        gfxs[fpath] = com.gfx
+    gfxs["a.jpg"].visible = False
+
+    itf.filter_tree("a.jpg", None)
+    itf.filter_tree("b.jpg", "a.jpg")
+    assert gfxs["a.jpg"].scene() is scene and gfxs["a.jpg"].parked
+    assert not gfxs["a.jpg"].visible
+    assert gfxs["b.jpg"].isVisible() and not gfxs["b.jpg"].parked
+
+    # Visibility set while parked is kept for later
+    gfxs["a.jpg"].visible = True
+    assert not gfxs["a.jpg"].isVisible()
+    itf.filter_tree("a.jpg", "b.jpg")
+    assert gfxs["a.jpg"].isVisible() and not gfxs["a.jpg"].parked
+    assert gfxs["b.jpg"].parked
+
+    # Only one image stays parked
+    itf.filter_tree("c.jpg", "a.jpg")
+    assert gfxs["a.jpg"].parked
+    assert gfxs["b.jpg"].scene() is None and not gfxs["b.jpg"].parked
+    assert list(scene.parked) == ["a.jpg"]
+
+def test_lazy_graphics(app, qtbot, tmp_path):
+    itf = app.interface
+    scene = itf.scene
+    files = app.file_widget
+    app.tool_bar.add_action.trigger()
+
+    fpaths = []
+    for row in (0, 1):
+        files.file_view.setCurrentIndex(files.file_model.index(row, 0, files.file_view.rootIndex()))
+        fpaths.append(scene.fpath)
+        scene.push(CreateShape(PangoBboxGraphic, QPointF(10, 10), scene.active_label))
+        scene.active_com.gfx.setSelected(False)
+
+    app.save_project(project_path=str(tmp_path / "project.p"))
+    app.load_project(project_path=str(tmp_path / "project.p"))
+
+    # Only the shown image has graphics, the other one's shape is data only
+    assert [type(gfx) for gfx in itf.map.values()].count(PangoBboxGraphic) == 1
+    assert len(itf.items_for(fpaths[0])) == 1
+    assert scene.stack.count() == 1
+
+    # Saved again before the other image was visited
+    app.save_project(project_path=str(tmp_path / "project.p"))
+    app.load_project(project_path=str(tmp_path / "project.p"))
+    assert len(itf.items_for(fpaths[0])) == 1
+
+    files.file_view.setCurrentIndex(files.file_model.index(0, 0, files.file_view.rootIndex()))
+    gfxs = [itf.map[item.key()] for item in itf.items_for(fpaths[0])]
+    assert gfxs[0].scene() is scene and gfxs[0].isVisible()
+    assert scene.stack.count() == 1 # History restored onto the new graphic
+    scene.stack.undo()
+    assert gfxs[0].scene() is None
+
+def test_changed_fields(app, qtbot):
+    itf = app.interface
+    scene = itf.scene
+    app.tool_bar.add_action.trigger()
+    app.tool_bar.add_action.trigger()
+
+    com = CreateShape(PangoBboxGraphic, QPointF(5, 5), scene.active_label)
+    scene.push(com)
+    scene.push(MoveShape(QPointF(50, 60), com.gfx, corner="bottomRight"))
+    item = itf.items_for(scene.fpath)[0]
+    assert item.rect is com.gfx.rect # Shared, moves need no sync
+    assert item.fpath == scene.fpath and item.name == com.gfx.name
+
+    # Only the changed field crosses over
+    reads = []
+    itf.changed_attrs = lambda obj, fields, f=itf.changed_attrs: reads.append(fields) or f(obj, fields)
+    com.gfx.setSelected(False)
+    item.name = "Renamed"
+    item.visible = False
+    assert com.gfx.toolTip() == "Renamed" and not com.gfx.isVisible()
+    assert reads == [{"name"}, {"visible"}]
+
+    itf.del_labels(0)
+    assert itf.model.rowCount() == 1